@@ -0,0 +1,426 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" bench.py
+
+               times playlist.py on a made-up library of audio files
+
+    usage:
+           bench.py  [options]
+
+           -n    <n>  audio files in the library (default 2000)
+
+           -d    <n>  directory levels above each album (default 2)
+
+           -t    <n>  bytes of extra tag text per file (default 64)
+
+           -j    <n>  probe n files at once (default 1)
+
+           -k    <n>  best of n runs of each phase (default 3)
+
+           -o    <file>  write the results there instead of standard output
+
+           --library <dir>  make the library there and keep it
+
+           --cache   also time probing with a warm metadata cache
+
+    The files are flac, mp3, m4a, ogg and opus in turn, with real
+    headers and tags and a few bytes of silence where the audio goes,
+    so the built-in readers handle them all and the external tools
+    are never run.  Each phase gives its time, files per second, its
+    own peak RSS ( where the kernel lets the peak be reset, else null )
+    and the peak RSS of the process so far, as JSON, so runs against
+    two versions of playlist.py can be compared.
+
+"""
+
+import os
+import sys
+import io
+import json
+import time
+import struct
+import shutil
+import tempfile
+import platform
+import resource
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath(__file__) ), ".." ) )
+
+import playlist
+
+
+FORMATS = ( "flac", "mp3", "m4a", "ogg", "opus" )
+
+TRACKS = 12         # files per album directory
+
+peak_rss_g = 0      # the most RSS seen by peak_rss()
+
+
+#-----------------------------
+# tag blocks
+
+def vorbis_comment(tags, vendor=b"bench"):
+
+    """ a vorbis comment block: vendor string, then NAME=value pairs """
+
+    out = struct.pack( "<I", len(vendor) ) + vendor + struct.pack( "<I", len(tags) )
+
+    for name, value in tags:
+        field = ( "%s=%s" % (name, value) ).encode('utf-8')
+        out += struct.pack( "<I", len(field) ) + field
+
+    return out
+
+
+def syncsafe(n):
+    return bytes( ( (n >> 21) & 0x7f, (n >> 14) & 0x7f, (n >> 7) & 0x7f, n & 0x7f ) )
+
+
+def id3v2(tags):
+
+    """ an ID3v2.3 tag with UTF-8 text frames """
+
+    ids = { "artist": b"TPE1", "title": b"TIT2", "album": b"TALB",
+            "date": b"TYER", "comment": b"TXXX" }
+    body = b""
+
+    for name, value in tags:
+        data = b"\x03" + value.encode('utf-8')
+        body += ids[name] + struct.pack( ">I", len(data) ) + b"\0\0" + data
+
+    return b"ID3" + bytes( ( 3, 0, 0 ) ) + syncsafe( len(body) ) + body
+
+
+#-----------------------------
+# one file of each kind
+
+def flac_file(tags, secs, rate=44100):
+
+    streaminfo = ( struct.pack( ">HH", 4096, 4096 ) + b"\0" * 6
+                   + struct.pack( ">Q", (rate << 44) | (1 << 41) | (15 << 36) | (secs * rate) )
+                   + b"\0" * 16 )
+
+    comment = vorbis_comment( tags )
+
+    return ( b"fLaC"
+             + b"\x00" + len(streaminfo).to_bytes( 3, 'big' ) + streaminfo
+             + b"\x84" + len(comment).to_bytes( 3, 'big' ) + comment
+             + b"\xff\xf8" * 32 )
+
+
+def mp3_file(tags, secs, kbps=128, rate=44100):
+
+    # MPEG-1 layer III, 44.1kHz, joint stereo; a Xing header gives the length
+    header = bytes( ( 0xff, 0xfb, 0x90, 0x40 ) )
+    size = 144 * kbps * 1000 // rate
+    frames = secs * rate // 1152
+
+    first = ( header + b"\0" * 32 + b"Xing" + struct.pack( ">II", 1, frames ) ).ljust( size, b"\0" )
+
+    return id3v2( [ ( n, v ) for n, v in tags ] ) + first + ( header + b"\0" * ( size - 4 ) ) * 4
+
+
+def box(kind, payload):
+    return struct.pack( ">I", 8 + len(payload) ) + kind + payload
+
+
+def m4a_file(tags, secs):
+
+    atoms = { "artist": b"\xa9ART", "title": b"\xa9nam", "album": b"\xa9alb",
+              "date": b"\xa9day", "comment": b"\xa9cmt" }
+
+    items = b"".join( box( atoms[name], box( b"data", struct.pack( ">II", 1, 0 )
+                                              + value.encode('utf-8') ) )
+                      for name, value in tags )
+
+    mvhd = box( b"mvhd", b"\0" * 4 + struct.pack( ">IIII", 0, 0, 1000, secs * 1000 ) + b"\0" * 80 )
+    meta = box( b"meta", b"\0" * 4 + box( b"hdlr", b"\0" * 24 ) + box( b"ilst", items ) )
+    moov = box( b"moov", mvhd + box( b"udta", meta ) )
+
+    return box( b"ftyp", b"M4A \0\0\0\0" ) + box( b"mdat", b"\0" * 64 ) + moov
+
+
+def ogg_page(packet, serial, seq, granule, flags):
+
+    lacing = b"\xff" * ( len(packet) // 255 ) + bytes( ( len(packet) % 255, ) )
+
+    return ( b"OggS" + bytes( ( 0, flags ) ) + struct.pack( "<qIII", granule, serial, seq, 0 )
+             + bytes( ( len(lacing), ) ) + lacing + packet )
+
+
+def ogg_file(tags, secs, opus=False):
+
+    serial = 0x62656e63
+
+    if opus:
+        ident = b"OpusHead" + bytes( ( 1, 2 ) ) + struct.pack( "<HIhB", 312, 48000, 0, 0 )
+        comment = b"OpusTags" + vorbis_comment( tags )
+        granule = secs * 48000 + 312
+    else:
+        ident = b"\x01vorbis" + struct.pack( "<IBI", 0, 2, 44100 ) + b"\0" * 12 + b"\x01"
+        comment = b"\x03vorbis" + vorbis_comment( tags ) + b"\x01"
+        granule = secs * 44100
+
+    return ( ogg_page( ident, serial, 0, 0, 2 )
+             + ogg_page( comment, serial, 1, 0, 0 )
+             + ogg_page( b"\0" * 64, serial, 2, granule, 4 ) )
+
+
+MAKERS = { "flac": flac_file, "mp3": mp3_file, "m4a": m4a_file,
+           "ogg": ogg_file, "opus": lambda tags, secs: ogg_file( tags, secs, True ) }
+
+
+#-----------------------------
+def make_library(root, count, depth=2, tag_size=64):
+
+    """ write a library of count audio files under root
+
+    Albums of TRACKS files sit depth directories down
+    ( root/level0-*/level1-*/album* ), and the formats go round FORMATS file by
+    file.  A comment tag of tag_size bytes is added to each file.
+
+    Args:
+        root(string):   where to put it
+        count(int):     number of audio files
+        depth(int):     directory levels above each album
+        tag_size(int):  extra tag bytes per file
+
+    Returns:
+        (int): bytes written
+
+    """
+
+    written = 0
+    comment = "x" * tag_size
+
+    for n in range(count):
+
+        album = n // TRACKS
+        parts = [ "level%d-%d" % ( level, album // ( 4 ** ( depth - level ) ) )
+                  for level in range(depth) ]
+        directory = os.path.join( root, *( parts + [ "album%05d" % album ] ) )
+
+        if n % TRACKS == 0:
+            os.makedirs( directory, exist_ok=True )
+
+        fmt = FORMATS[ n % len(FORMATS) ]
+        tags = [ ( "artist", "Artist %d" % ( album % 97 ) ),
+                 ( "title", "Track %d é" % n ),
+                 ( "album", "Album %d" % album ),
+                 ( "date", "%d" % ( 1960 + album % 60 ) ) ]
+        if tag_size:
+            tags.append( ( "comment", comment ) )
+
+        data = MAKERS[fmt]( tags, 60 + n % 300 )
+
+        with open( os.path.join( directory, "%02d track.%s" % ( n % TRACKS, fmt ) ), 'wb' ) as f:
+            f.write( data )
+
+        written += len(data)
+
+    return written
+
+
+#-----------------------------
+def peak_rss():
+
+    """ the most memory the process has held, in KiB
+
+    The kernel's figure drops with reset_peak_rss(), so the most seen
+    before is kept.
+
+    """
+
+    global peak_rss_g
+
+    peak = resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+
+    peak_rss_g = max( peak_rss_g, peak // 1024 if sys.platform == "darwin" else peak )
+
+    return peak_rss_g
+
+
+def reset_peak_rss():
+
+    """ start the peak over from what the process holds now ( Linux )
+
+    Returns:
+        (boolean): whether it could be; if not phase_peak_rss() can't
+                   be used
+
+    """
+
+    try:
+        with open( "/proc/self/clear_refs", 'w' ) as f:
+            f.write( "5" )
+        return True
+    except OSError:
+        return False
+
+
+def phase_peak_rss():
+
+    """ the most memory held since reset_peak_rss(), in KiB """
+
+    with open( "/proc/self/status" ) as f:
+        for line in f:
+            if line.startswith( "VmHWM:" ):
+                return int( line.split()[1] )
+
+    return None
+
+
+def timed(runs, count, fn):
+
+    """ run fn runs times and keep the fastest
+
+    Returns:
+        (dict, value): the phase's figures and what fn returned last
+
+    """
+
+    best = None
+    peak_rss()          # keep the peak so far before the kernel's is reset
+    reset = reset_peak_rss()
+
+    for i in range(runs):
+        start = time.perf_counter()
+        value = fn()
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min( best, seconds )
+
+    peak = phase_peak_rss() if reset else None
+
+    return { "seconds": round( best, 6 ),
+             "files_per_sec": round( count / best, 1 ) if best else None,
+             "peak_rss_kib": peak,
+             "process_peak_rss_kib": max( peak_rss(), peak or 0 ) }, value
+
+
+def run(root, runs=3, jobs=1, cache=False):
+
+    """ time each phase of making a playlist of the library under root
+
+    Returns:
+        (dict): phase name -> figures
+
+    """
+
+    phases = {}
+
+    playlist.quiet_g = True
+    playlist.cache_g = None
+    playlist.set_backend( "native" )
+
+    count = len( playlist.get_files( [ root ], True ) )
+
+    phases["discovery"], files = timed( runs, count,
+                                        lambda: playlist.get_files( [ root ], True ) )
+
+    probe = lambda: list( playlist.probe_all( files, jobs, playlist.batch_g, None,
+                                              playlist.window_g ) )
+
+    phases["probing"], tracks = timed( runs, count, probe )
+
+    failed = sum( 1 for t in tracks if not t )
+
+    phases["rendering"], summary = timed( runs, count,
+                                          lambda: playlist.render_m3u( tracks, io.StringIO() ) )
+
+    out = os.path.join( root, "bench.m3u" )
+    phases["write_m3u"], written = timed( runs, count,
+                                       lambda: playlist.write_m3u( playlist.get_files( [ root ], True ),
+                                                                   out, jobs=jobs ) )
+    os.unlink( out )
+
+    if cache:
+        dbdir = tempfile.mkdtemp( prefix="playlist-bench-cache" )
+
+        try:
+            playlist.cache_g = playlist.MetaCache( os.path.join( dbdir, "metadata.db" ) )
+
+            phases["probing_cold_cache"], tracks = timed( 1, count, probe )
+            phases["probing_warm_cache"], tracks = timed( runs, count, probe )
+
+            playlist.cache_g.close()
+
+        finally:
+            playlist.cache_g = None
+            shutil.rmtree( dbdir )
+
+    return { "files": count, "failed": failed, "phases": phases }
+
+
+#-----------------------------
+def main(args):
+
+    count, depth, tag_size, jobs, runs = 2000, 2, 64, 1, 3
+    outfile = library = None
+    cache = False
+
+    i = 1
+    while i < len(args):
+        o = args[i]
+        i += 1
+        name = o.split("=", 1)[0] if o.startswith("--") else o
+
+        if name in ( "-h", "--help" ):
+            sys.stdout.write( __doc__ )
+            sys.exit( playlist.NOERR )
+
+        elif name in ( "-n", "-d", "-t", "-j", "-k" ):
+            value, i = playlist.option_value( o, args, i )
+            value = playlist.int_value( o, value )
+
+            if name == "-n":   count = value
+            elif name == "-d": depth = value
+            elif name == "-t": tag_size = value
+            elif name == "-j": jobs = value
+            else:              runs = max( 1, value )
+
+        elif name == "-o":
+            outfile, i = playlist.option_value( o, args, i )
+
+        elif name == "--library":
+            library, i = playlist.option_value( o, args, i )
+
+        elif o == "--cache":
+            cache = True
+
+        else:
+            playlist.fatal( ("unknown option %s\n" % o), playlist.EINVAL )
+
+    root = library or tempfile.mkdtemp( prefix="playlist-bench" )
+
+    try:
+        start = time.perf_counter()
+        size = make_library( root, count, depth, tag_size )
+        made = time.perf_counter() - start
+
+        results = run( root, runs, jobs, cache )
+
+    finally:
+        if not library:
+            shutil.rmtree( root )
+
+    results.update( version=playlist.__version__,
+                    python=platform.python_version(),
+                    platform=platform.platform(),
+                    date=time.strftime( "%Y-%m-%dT%H:%M:%S" ),
+                    jobs=jobs, runs=runs,
+                    library={ "files": count, "depth": depth, "tag_size": tag_size,
+                              "bytes": size, "seconds_to_make": round( made, 3 ) } )
+
+    text = json.dumps( results, indent=2, sort_keys=True ) + "\n"
+
+    if outfile:
+        with open( outfile, 'w' ) as f:
+            f.write( text )
+    else:
+        sys.stdout.write( text )
+
+
+if __name__ == '__main__':
+
+    main( sys.argv )
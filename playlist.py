@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
 # creates a playlist from a list of flac, mp3, or m4a files
@@ -44,7 +44,7 @@ __URL__         = "https://github.com/spikeysnack/playlist"
 
 __depends__     = ( "metaflac", "mp3info", "mp4info", "ogginfo" )
 
-__extensions__   = ( "flac" , "mp3", "m4a", "ogg" )
+__extensions__   = ( "flac" , "mp3", "m4a", "ogg", "opus" )
 
 
 
@@ -53,11 +53,34 @@ __extensions__   = ( "flac" , "mp3", "m4a", "ogg" )
 import os
 import sys
 import shutil
-import glob
 import fileinput
 import subprocess
 import fnmatch
+import threading
+import time
+import struct
+import math
+import json
+import hashlib
+import io
+import select
+import socket
+import signal
 from random import shuffle
+from itertools import chain, groupby
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+try:
+    import sqlite3
+except ImportError:  # python built without it
+    sqlite3 = None
+
+try:
+    import ctypes
+    import ctypes.util
+except ImportError:  # --watch needs it
+    ctypes = None
 
 
 # globals
@@ -66,90 +89,139 @@ from random import shuffle
 
 extensions = ( "flac" , "mp3", "m4a", "ogg", "opus" )
 
-PY3 = sys.version_info > (3,) #global boolean
+quiet_g= False
 
-album_name_g  = ""  # global
-alb_count = 0
+jobs_g = 1          # metadata probes run at once (-j)
+backend_g = {}      # format -> "auto", "native" or "external" (--backend)
+tools_g = {}        # external tool -> full path or None
+batch_g = 64        # files per external tool run (-b)
+window_g = 256      # files in flight, waiting to be written (-w)
 
-artist_name_g = ""
-art_count = 0
+update_g = False    # --update: reuse the entries of the old playlist
 
-date_g = ""
-date_count_g = 0
+cache_g = None      # MetaCache of probed tags
+cache_mode_g = "on" # --no-cache  --rebuild-cache
 
-quiet_g= False
+CACHE_MAX_ENTRIES = 250000  # rows kept before the oldest are evicted
+QUARANTINE_RETRY = 86400    # seconds before a file that failed is tried again,
+QUARANTINE_MAX = 30 * 86400 # doubling with each failure up to this
 
-#posix exit codes
-NOERR  = 0 # normal exit
-EPERM  = 1 # operation not permitted
-ENOENT = 2  # no such file or directory
-EINVAL = 22 # invalid argument
-ENOSYS = 38 # function not implemented
+fallback_g = False  # --fallback: list unreadable files under their file name
 
+fast_g = False      # --fast: tags from the head of a file, lengths estimated
+FAST_HEAD = 8192    # all of a file --fast reads for tags, in one go
 
-def set_albumname(name=""):
-    """ try to set the album name """
-    global album_name_g
-    global alb_count
+watch_g = False     # --watch: rewrite the playlist as the files change
+WATCH_QUIET = 2.0   # seconds without events before rewriting
+WATCH_MAX_WAIT = 30.0  # longest a rewrite waits on a busy directory
 
-    alb_count +=1
+per_directory_g = False  # --per-directory: a playlist in each album directory
 
+daemon_g = False    # --daemon: serve playlists over a unix socket
 
-    if not album_name_g == "":
+stats_g = None      # Stats of this run ( --stats )
+stats_file_g = None # --stats-file: where to write them as JSON
 
-        album_name_g = name
+timeout_g = 30      # seconds an external probe may run before it is killed
+retry_g = False     # --retry: give a killed probe one more go
+deadline_g = None   # --deadline: seconds a run may spend probing
+deadline_at_g = None    # time.monotonic() at which this run's deadline passes
+skipped_g = []      # ( file, why ) of the files given up on
 
-    elif name != album_name_g:
+# set from the command line; put back before each daemon request
+SETTINGS = ( "quiet_g", "jobs_g", "backend_g", "batch_g", "window_g",
+             "update_g", "watch_g", "per_directory_g", "stats_g", "stats_file_g",
+             "timeout_g", "retry_g", "deadline_g", "skipped_g", "fallback_g",
+             "fast_g" )
 
-        album_name_g="compilation"
+# these run in the process they were typed in, not in the daemon
+LOCAL_OPTIONS = ( "--daemon", "--no-daemon", "--watch", "--no-cache", "--rebuild-cache",
+                  "--show-quarantine" )
 
-    else:
-        pass
+#posix exit codes
+NOERR  = 0 # normal exit
+EPERM  = 1 # operation not permitted
+ENOENT = 2  # no such file or directory
+EINVAL = 22 # invalid argument
+ENOSYS = 38 # function not implemented
 
 
+class Summary(object):
 
-def set_artistname(name=""):
-    """ try to set the album name """
+    """ what a playlist's footer says of its files: artist, album and date
 
-    global artist_name_g
+    A name is None until a file has one, the name while every file
+    agrees, and MIXED once two differ; the date is the latest seen
+    and the seconds add up, leaving out files of unknown length.
+    approx is set once a length added in was an estimate ( --fast ).
+    Two summaries merge into the summary of both lists of files, and
+    merging is associative and commutative, so parts added up
+    separately ( per worker, per directory ) can be combined in any
+    grouping without a lock.
 
-    global art_count
+    """
 
-    art_count +=1
+    MIXED = object()
 
+    def __init__(self, artist=None, album=None, date=None, count=0, seconds=0,
+                 approx=False):
+        self.artist = artist
+        self.album = album
+        self.date = date
+        self.count = count          # files summed up
+        self.seconds = seconds
+        self.approx = approx
 
-    if not artist_name_g:
 
-        artist_name_g = name
+    @staticmethod
+    def name(a, b):
+        if a is None or a == b:
+            return b
+        if b is None:
+            return a
+        return Summary.MIXED
 
-    elif name != artist_name_g:
 
-        artist_name_g="Various Artists"
+    def add(self, track):
 
-    else:
-        pass
+        """ count one file in
 
+        Args:
+            track(Track):  the file's tags
 
-def set_date(date=""):
-    """ try to set the album name """
+        """
 
-    global date_g
+        self.artist = self.name( self.artist, track.artist or None )
+        self.album = self.name( self.album, track.album or None )
+        self.date = max( self.date or "", track.date or "" ) or None
+        self.count += 1
+        self.seconds += max( track.seconds, 0 )
+        self.approx = self.approx or track.approx
 
-    global date_count_g
 
-    date_count_g +=1
+    def merge(self, other):
 
-    if not date_g:
+        """ the summary of both lists of files """
 
-        date_g = date
+        return Summary( self.name( self.artist, other.artist ),
+                        self.name( self.album, other.album ),
+                        max( self.date or "", other.date or "" ) or None,
+                        self.count + other.count, self.seconds + other.seconds,
+                        self.approx or other.approx )
 
-    elif date != date_g:
 
-        date_g = date
+    def footer(self):
 
-    else:
-        pass
+        """ ( artist, album, date ) as the footer prints them """
+
+        def show(value, mixed):
+            if value is self.MIXED:
+                return mixed
+            return value or ""
 
+        return ( show( self.artist, "Various Artists" ),
+                 show( self.album, "compilation" ),
+                 self.date or "" )
 
 
 
@@ -234,15 +306,19 @@ def usage(stream=sys.stdout, len="short"):
     r"""
       usage:
              playlist
-             playlist  [option] <dir>
+             playlist  [options] <dir>
 
              -a    use <current-dir>.m3u as playlist name
 
+             -b    <n>  files per metaflac/mp3info run (default 64)
+
              -c    check system for info utilities
 
              -f    <file>  write m3u to file instead of standard output
 
              -h    print this help
+
+             -j    <n>  probe n files at once (0 = automatic)
     
              -q    quiet no warnings or info 
 
@@ -250,8 +326,42 @@ def usage(stream=sys.stdout, len="short"):
             
              -s    sort playlist numerically
 
+             -w    <n>  most files probed ahead of the output (default 256)
+
              -R    randomize playlist
 
+             --no-cache don't read or write the metadata cache
+
+             --rebuild-cache forget cached tags and probe every file again
+
+             --backend <fmt>=<auto|native|external>  how to read a format
+
+             --update <file>  rewrite <file>, probing only new and changed files
+
+             --watch keep the playlist file up to date as files change (Linux)
+
+             --per-directory write <dir>.m3u into every directory with audio files (implies -r)
+
+             --daemon keep the cache warm and answer other playlist runs over a socket
+
+             --no-daemon don't hand this run to a running daemon
+
+             --stats print where the time went: phases, latencies, cache hits
+
+             --stats-file <file>  also write the stats there as JSON
+
+             --timeout <secs>  kill an external probe after this long (default 30, 0 = never)
+
+             --retry try a killed probe once more before skipping its file
+
+             --deadline <secs>  stop probing after this long and skip the rest
+
+             --fallback list files that can't be read under their file name instead of leaving them out
+
+             --show-quarantine list the files that failed to read and are left alone until they change
+
+             --fast estimate lengths from the bitrate and read tags from the head of each file only; estimates are marked approx
+
 """
 
     longmsg = \
@@ -280,784 +390,4162 @@ def usage(stream=sys.stdout, len="short"):
 
 
 #-----------------------------
-def get_flac_entry( flacfile):
-    
-    
-    """ extract info from a flac file
+def cache_file():
 
-    Args:
-        flacfile(string): name of a flac audio file
+    """ where the metadata cache lives
 
     Returns:
-        (string): a M3U-EX  entry for the file
-
-    Raises:
-       OSError: file access problems
-       ValueError: data not in proper format in flac file
+        (string): $XDG_CACHE_HOME/playlist/metadata.db  (~/.cache by default)
 
 """
 
-    
-    global album_name_g
-    global artist_name_g
+    base = os.environ.get("XDG_CACHE_HOME") or \
+           os.path.join( os.path.expanduser("~"), ".cache" )
 
-    mf    = "metaflac"
-    sr    = "--show-sample-rate"
-    bps   = "--show-bps"
-    tots  = "--show-total-samples"
-    art   = "--show-tag=artist"
-    tit   = "--show-tag=title"
-    alb   = "--show-tag=album"
-    dat   = "--show-tag=date"
+    return os.path.join( base, "playlist", "metadata.db" )
 
-    mfcmd = [ mf, tit, art, alb, sr, tots, dat, flacfile ]
 
-    if not which(mf):
-        fatal(" I can't find metaflac in path. Install?]\n", ENOENT)
+def daemon_socket():
 
+    """ where playlist --daemon listens
 
-    flacexists = os.path.exists ( flacfile )
+    Returns:
+        (string): $XDG_RUNTIME_DIR/playlist.sock, or daemon.sock
+                  beside the metadata cache
 
-    if not flacexists:
-        return None
-    else:
-        try:
-            p = subprocess.Popen( mfcmd , stdout=subprocess.PIPE)
+"""
 
-            databytes, err = p.communicate()
+    run = os.environ.get("XDG_RUNTIME_DIR")
 
-            data = databytes.decode('utf-8')
-            info = data.split('\n')
+    if run:
+        return os.path.join( run, "playlist.sock" )
 
-            title  = info[0].split('=')[1]
-            artist = info[1].split('=')[1]
-            album  = info[2].split('=')[1]
+    return os.path.join( os.path.dirname( cache_file() ), "daemon.sock" )
 
-            sample_rate  =  int(info[3])
-            total_samples = int(info[4])
 
-            date  = info[5].split('=')[1]
+class MetaCache(object):
 
-            set_artistname(artist)
-            set_albumname(album)
-            set_date(date)
-            
-            secs = round( total_samples / sample_rate )
+    """ a persistent store of probed tags
 
-            output = "#EXTINF:" + str(secs) + "," + artist + " - " + title + "\n" + flacfile
-        # print ("output\t[%s]\n" % output )
+    Rows are keyed on the absolute path of a file and remember its
+    size, mtime and inode; a row is only used while all three still
+    match the file on disk, so new or changed files get probed again.
+    Once there are more than max_entries rows the least recently used
+    ones are dropped.
 
-            return output
-        
-        except OSError as oserr:
-            if not quiet_g: 
-                warning(( str(oserr) ))
+    A second table keeps a fragment per directory for recursive runs
+    ( see walk_tree ), and a third the files that couldn't be read:
+    they are left alone until they change on disk or their back-off
+    runs out, which doubles with every failure.  The directories whose
+    fragments are to be stored again wait in a fourth.
 
-        except ValueError as valerr:
-            if not quiet_g:
-                warning(( str(valerr) ))
+    Writes, and the stamps of the rows used, go to the database every
+    256, so memory doesn't grow with the library.
 
+    The object may be shared by the probe threads.
 
+    """
 
+    def __init__(self, dbfile, max_entries=CACHE_MAX_ENTRIES, rebuild=False):
 
-#---------------------------
-def get_mp3_entry( mp3file):
+        dbdir = os.path.dirname( dbfile )
+        if dbdir and not os.path.isdir( dbdir ):
+            os.makedirs( dbdir )
 
-    """ extract info from an mp3 file
+        self.db = sqlite3.connect( dbfile, timeout=30, check_same_thread=False )
+        self.lock = threading.Lock()
+        self.max_entries = max_entries
+        self.stamp = int( time.time() )
+        self.hits = []      # rows used since the last stamping
+        self.pending = 0    # rows written since the last commit
+        self.known = {}     # file -> tags from a directory fragment
 
-    Args:
-        mp3file(string): name of a mp3 audio file
+        with self.lock:
+            self.db.execute( "CREATE TABLE IF NOT EXISTS meta ("
+                             " path TEXT PRIMARY KEY,"
+                             " size INTEGER, mtime_ns INTEGER, inode INTEGER,"
+                             " artist TEXT, title TEXT, album TEXT, date TEXT,"
+                             " seconds INTEGER, used INTEGER )" )
+            self.db.execute( "CREATE INDEX IF NOT EXISTS meta_used ON meta (used)" )
+            self.db.execute( "CREATE TABLE IF NOT EXISTS dirs ("
+                             " path TEXT PRIMARY KEY,"
+                             " mtime_ns INTEGER, fingerprint TEXT, own TEXT,"
+                             " files TEXT, subdirs TEXT )" )
+            self.db.execute( "CREATE TABLE IF NOT EXISTS quarantine ("
+                             " path TEXT PRIMARY KEY,"
+                             " size INTEGER, mtime_ns INTEGER,"
+                             " error TEXT, failures INTEGER, retry INTEGER )" )
+            self.db.execute( "CREATE TABLE IF NOT EXISTS marked ("
+                             " path TEXT PRIMARY KEY, depth INTEGER,"
+                             " mtime_ns INTEGER, names TEXT, subdirs TEXT )" )
+            if rebuild:
+                self.db.execute( "DELETE FROM meta" )
+                self.db.execute( "DELETE FROM dirs" )
+                self.db.execute( "DELETE FROM quarantine" )
+                self.db.execute( "DELETE FROM marked" )
+            self.db.commit()
 
-    Returns:
-        (string): a M3U-EX  entry for the file
 
-    Raises:
-       OSError: file access problems
-       ValueError: data not in proper format in mp3 file
+    def get(self, path, st):
 
+        """ cached tags for a file
 
-   Note:
-       "<file>  does not have an ID3 1.x tag" is an error that comes
-        if file has no  ID3v1 tag. It may have and IDv2 tag, though,
-        and be perfectly legitimate. Try using a tagging program
-        like mp3tag (windows, works with wine on linux) to copy the id3v2
-        tag to an id3v1 tag and it will work. or the tags might actually be
-        missing. This function tries to get the data from the file name if so.
+        Args:
+            path(string):    name of the audio file
+            st(stat_result): os.stat() of the file
 
-"""
+        Returns:
+            (Track): the file's tags and length, or None
 
-    # ver = "%v"
-    # sr  = "%Q"
-    # bps = "%r"
-    # frames = "%u"
-    # art   = "%a"
-    # tit   = "%t"
-    # alb   = "%l"
-    # dat   = "%y"
-    
-    mp    = "mp3info"
+        """
 
-    if not which(mp):
-        fatal("I can't find mp3info in path. Install?]\n", ENOENT)
+        key = os.path.abspath( path )
 
+        with self.lock:
+            row = self.db.execute( "SELECT size, mtime_ns, inode,"
+                                   " artist, title, album, date, seconds"
+                                   " FROM meta WHERE path = ?", (key,) ).fetchone()
 
-    mp3exists = os.path.exists ( mp3file )
+            if row is None or row[:3] != ( st.st_size, st.st_mtime_ns, st.st_ino ):
+                return None
 
-    options = "%a\n%t\n%l\n%y\n%S\n"
+            self.hits.append( key )
+            if len(self.hits) >= 256:
+                self.stamp_hits()
 
-    output = None
+        return Track( path, *row[3:] )
 
-    if not mp3exists:
-        return None
-    else:
-        try:
 
-            p = subprocess.Popen( [mp, "-p", options,  mp3file ] , stdout=subprocess.PIPE)
+    def stamp_hits(self):
 
-            infobytes, err = p.communicate()
-            info = infobytes.decode('utf-8')
-            info =  info.split('\n')
+        """ mark the rows used as used this run, with the lock held """
 
-            artist =  info[0]
-            title  =  info[1]
-            album  =  info[2]
-            year   =  info[3]
-            secs   =  info[4]
+        self.db.executemany( "UPDATE meta SET used = ? WHERE path = ?",
+                             ( (self.stamp, p) for p in self.hits ) )
+        self.pending += len(self.hits)
+        self.hits = []
+        self.wrote()
 
-            output = "#EXTINF:" + str(secs)  + "," + artist + " - " + title + "\n" + mp3file
 
-            # print("output:\t %s\n" % output )
+    def wrote(self):
 
-            set_albumname(album)
+        """ commit every 256 rows written, with the lock held """
 
-            set_artistname(artist)
+        if self.pending >= 256:
+            self.db.commit()
+            self.pending = 0
 
-            set_date(year)
 
-        except OSError as o:
-            print(( str(0) ))
+    def put(self, path, st, track):
 
-        except ValueError as v:
-            print(( str(v) ))
+        """ remember the tags of a file
 
-    return output
+        Args:
+            path(string):    name of the audio file
+            st(stat_result): os.stat() of the file when it was probed
+            track(Track):    what was found
 
-#---------------------------
+        """
 
-def get_m4a_entry( m4afile):
+        row = ( os.path.abspath( path ),
+                st.st_size, st.st_mtime_ns, st.st_ino ) + track.fields() + ( self.stamp, )
 
-    """ extract info from an m4a (itunes)  file
+        with self.lock:
+            self.db.execute( "INSERT OR REPLACE INTO meta VALUES (?,?,?,?,?,?,?,?,?,?)", row )
+            self.db.execute( "DELETE FROM quarantine WHERE path = ?", row[:1] )
+            self.pending += 1
+            self.wrote()
 
-    Args:
-        m4afile(string): name of a m4a audio file
 
-    Returns:
-        (string): a M3U-EX  entry for the file
+    def quarantined(self, path, st):
 
-    Raises:
-       OSError:    file access problems
-       ValueError: data not in proper format in m4a file
+        """ whether a file that failed before should be left alone
 
-"""
-# mp4info output:
-#
-# 01 J.S. Bach - English Suite N.2 Bourree 1.m4a:
-# Track	Type	Info
-# 1	audio	alac, 102.000 secs, 875 kbps, 44100 Hz
-#  Name: J.s. Bach - English Suite N.2: Bourree 1
-#  Artist: Eddy Antonini
-#  Sort Artist: Eddy Antonini
-#  Encoded with: qaac 0.47, QuickTime 7.6.9
-#  Release Date: 1998
-#  Album: When Water Became Ice
-#  Sort Album: When Water Became Ice
-#  Track: 1 of 12
-#  Genre: Power Metal
-#  Cover Art pieces: 1
-#  Album Artist: Eddy Antonini
-#  Sort Album Artist: Eddy Antonini
-#  Lyrics:
-#  [instrumental]
+        Args:
+            path(string):    name of the audio file
+            st(stat_result): os.stat() of the file
 
-    global album_name_g
-    mp4info    = "mp4info"
-    artist = ""
-    title  = ""
-    album = ""
-    date = ""
-    secs   = 0
+        Returns:
+            (string): the error it failed with, or None if it is to be
+                      probed: it never failed, it has changed since,
+                      or its back-off has run out
 
+        """
 
-    if not which(mp4info):
-        fatal("[can't find mp4info in path. Install?]\n", ENOENT)
+        with self.lock:
+            row = self.db.execute( "SELECT size, mtime_ns, error, retry"
+                                   " FROM quarantine WHERE path = ?",
+                                   ( os.path.abspath( path ), ) ).fetchone()
 
+        if row is None or row[:2] != ( st.st_size, st.st_mtime_ns ) or row[3] <= time.time():
+            return None
 
-    m4aexists = os.path.exists ( m4afile )
+        return row[2]
 
-    samples_per_frame = 0
-    secs = -1
 
-    if not m4aexists:
-        return None
-    else:
-        try:
+    def quarantine(self, path, st, err):
 
-            p = subprocess.Popen( [mp4info,  m4afile ] ,
-                                  stderr=subprocess.PIPE,
-                                  stdout=subprocess.PIPE )
+        """ remember that a file couldn't be read
 
-            mp4_infobytes, err = p.communicate()
+        The back-off starts at QUARANTINE_RETRY and doubles each time
+        the same file fails again, up to QUARANTINE_MAX.
 
-            info = mp4_infobytes.decode('utf-8')
+        Args:
+            path(string):    name of the audio file
+            st(stat_result): os.stat() of the file when it was probed
+            err(string):     why it failed
 
-            m4ainfo = info.split('\n')
+        """
 
-            for entry in m4ainfo:
+        key = os.path.abspath( path )
 
-                if "Artist" in entry:
-                    artist = entry.split(':')[1].strip()
+        with self.lock:
+            row = self.db.execute( "SELECT size, mtime_ns, failures"
+                                   " FROM quarantine WHERE path = ?", (key,) ).fetchone()
 
-                if "Name" in entry:
-                    n = entry.split(':')
-                    if len(n) == 2:
-                        title = str(n[1])
-                    else:
-                        title = str(n)
+            failures = 1
+            if row and row[:2] == ( st.st_size, st.st_mtime_ns ):
+                failures = row[2] + 1
 
-                if "Title" in entry:
-                    title = entry.split(':',1)[1].strip()
+            backoff = min( QUARANTINE_RETRY * 2 ** ( failures - 1 ), QUARANTINE_MAX )
 
-                if "Album" in entry:
-                    if not "Gapless" in entry:
-                        album = entry.split(':',1)[1].strip()
-                        set_albumname(album)
+            self.db.execute( "INSERT OR REPLACE INTO quarantine VALUES (?,?,?,?,?,?)",
+                             ( key, st.st_size, st.st_mtime_ns, err, failures,
+                               int( time.time() + backoff ) ) )
+            self.pending += 1
+            self.wrote()
 
-                if "secs" in entry.lower():
-                    s = entry.split(',')
-                    s = s[1].split()[0]
-                    secs = int(round(float(s)))
 
-        except OSError as o:
-            if not quiet_g:
-                warning(( str(o) ))
+    def quarantine_list(self):
 
-        except ValueError as v:
-            if not quiet_g:
-                warning(( str(v) ))
+        """ the files in quarantine
 
-        m3uline = "#EXTINF:" + str(secs)  + "," + artist + " - " + title + "\n" + m4afile
-        return m3uline
+        Returns:
+            (list): ( path, error, failures, retry ) by path, retry being
+                    when the file will next be tried, in epoch seconds
 
+        """
 
-#---------------------------
-def get_ogg_entry( oggfile):
+        with self.lock:
+            return self.db.execute( "SELECT path, error, failures, retry"
+                                    " FROM quarantine ORDER BY path" ).fetchall()
 
-    """ extract info from an m4a (itunes)  file
 
-    Args:
-        m4afile(string): name of a m4a audio file
+    def get_dir(self, path):
 
-    Returns:
-        (string): a M3U-EX  entry for the file
+        """ the stored fragment of a directory ( see walk_tree )
 
-    Raises:
-       OSError: file access problems
-       ValueError: data not in proper format in mp3 file
+        Args:
+            path(string): the directory
 
-"""
-    global album_name_g
-    ogg = "ogginfo"
-    artist = ""
-    title  = ""
-    album = ""
-    secs   = 0
+        Returns:
+            (tuple): ( mtime_ns, fingerprint, own, files, subdirs ) where
+                     files is a list of [ name, size, mtime_ns, tags ],
+                     own the hash of the directory's own part;
+                     or None if it has never been stored
 
-#    title=Custer's Last Stand
-#    artist=Rick Wakeman
-#    album=Time Machine
-#    genre=Rock
-#    date=1988
-#    tracknumber=01
-# Vorbis stream 1:
-#    Total data length: 3411006 bytes
-#    Playback length: 4m:02.306s
-#    Average bitrate: 112.617702 kb/s
+        """
 
+        with self.lock:
+            row = self.db.execute( "SELECT mtime_ns, fingerprint, own, files, subdirs"
+                                   " FROM dirs WHERE path = ?",
+                                   ( os.path.abspath(path), ) ).fetchone()
+        if row is None:
+            return None
 
-    if not which(ogg):
-        fatal("[ I can't find ogginfo in path. Install? ]\n", ENOENT )
+        mtime_ns, fingerprint, own, files, subdirs = row
 
+        return mtime_ns, fingerprint, own, json.loads(files), json.loads(subdirs)
 
-    m4aexists = os.path.exists ( oggfile )
 
-    samples_per_frame = 0
-    secs = -1
+    def mark_dir(self, path, mtime_ns, names, subdirs):
 
-    if not m4aexists:
-        return None
-    else:
-        try:
+        """ note a directory whose fragment must be stored again on close()
 
-            p = subprocess.Popen( [ogg, oggfile ] , stdout=subprocess.PIPE)
+        Args:
+            path(string):    the directory
+            mtime_ns(int):   its mtime when it was listed
+            names(list):     its audio files, in listing order
+            subdirs(list):   its subdirectories, in listing order
 
-            infobytes, err = p.communicate()
+        """
 
-            ogginfo=infobytes.decode('utf-8')
+        path = os.path.abspath(path)
 
-            ogginfo = ogginfo.split('\n')
+        with self.lock:
+            self.db.execute( "INSERT OR REPLACE INTO marked VALUES (?,?,?,?,?)",
+                             ( path, path.count(os.sep), mtime_ns,
+                               json.dumps( names ), json.dumps( subdirs ) ) )
+            self.pending += 1
+            self.wrote()
 
-            #print( ogginfo )
 
-            for entry in ogginfo:
-                #print("OGG ENTRY:\t[%s]\n" % entry )
+    def forget_dir(self, path):
 
-                if not artist:
-                    if "artist" in entry:
-                        artist = entry.split('=')[1].strip()
+        """ drop a directory's fragment, so it is listed and stat'ed again
 
-                if not title:
-                    if "title" in entry:
-                        title = entry.split('=')[1].strip()
+        For --watch, which is told of files edited in place that leave
+        the directory's mtime alone.
 
-                if "album" in entry.lower():
-                    album = entry.split('=')[1].strip()
-                    set_albumname(album)
+        Args:
+            path(string):    the directory
 
-                # Playback length: 8m:37.106s
-                if "Playback length:" in entry:
+        """
 
-                    s = entry.split(':')[1:]
-                    #print("s:\t%s\n" % s)
+        with self.lock:
+            self.db.execute( "DELETE FROM dirs WHERE path = ?",
+                             ( os.path.abspath(path), ) )
 
-                    # not compatabile with python3
-                    #minutes = filter(lambda x: x.isdigit(), s[0])
-                    #seconds = filter(lambda x: x.isdigit(), s[1])
 
-                    # python 2 and python3 syntax strip non digits
-                    # note: kills decimal point too.
-                    minutes = ''.join([x for x in s[0] if x.isdigit()])
-                    seconds = ''.join([x for x in s[1] if x.isdigit()])
+    def store_dirs(self):
 
-                   # print("minutes:\t%s\n" % minutes)
-                   # print("seconds:\t%s\n" % seconds)
+        """ render and store the fragments of the directories marked
 
-                    secs = (60 * int(minutes)) + (int(seconds)/1000)
-                    #print( "SECS:\t[%s]\n" % secs)
+        Called with the lock held.  Children are done before their
+        parents, so each fingerprint can roll up those below it.
 
-        except OSError as o:
-            if not quiet_g:
-                warning(( str(0) ))
+        """
 
-        except ValueError as v:
-            if not quiet_g:
-                warning(( str(v) ))
+        by_depth = self.db.cursor().execute( "SELECT path, mtime_ns, names, subdirs"
+                                             " FROM marked ORDER BY depth DESC" )
 
-        output = "#EXTINF:" + str(secs)  + "," + artist + " - " + title + "\n" + oggfile
-        #print("output:\t %s\n" % output )
+        for path, mtime_ns, names, subdirs in by_depth:
 
-        return output
+            names, subdirs = json.loads( names ), json.loads( subdirs )
 
+            files = []
 
+            for name in names:
+                row = self.db.execute( "SELECT size, mtime_ns,"
+                                       " artist, title, album, date, seconds"
+                                       " FROM meta WHERE path = ?",
+                                       ( os.path.join( path, name ), ) ).fetchone()
+                if row:
+                    files.append( [ name, row[0], row[1], list( row[2:] ) ] )
+                else:
+                    files.append( [ name, None, None, None ] )
 
-#---------------------
-def hms(sec):
-    """ convert seconds to hms string """
+            own = hashlib.sha1( json.dumps( [ mtime_ns, [ f[:3] for f in files ] ] )
+                                .encode('utf-8') ).hexdigest()
 
-    dhour = int(sec / 3600)
-    dmin = int( (sec/60) - dhour*60 )
-    dsec = int( sec - ( dhour*3600 + dmin*60) )
-    # print ("dhour", dhour)
-    # print ("dmin", dmin)
-    # print ("dsec", dsec)
+            children = []
+            for sub in subdirs:
+                row = self.db.execute( "SELECT fingerprint FROM dirs WHERE path = ?",
+                                       ( os.path.join( path, sub ), ) ).fetchone()
+                children.append( row[0] if row else "" )
 
-    h = "{:02d}".format(dhour)
-    m = "{:02d}".format(dmin)
-    s = "{:02d}".format(dsec)
+            self.db.execute( "INSERT OR REPLACE INTO dirs VALUES (?,?,?,?,?,?)",
+                             ( path, mtime_ns, dir_fingerprint( own, children ), own,
+                               json.dumps( files ), json.dumps( subdirs ) ) )
 
-    return  ':'.join( (h, m, s) )
+        self.db.execute( "DELETE FROM marked" )
 
 
-#----------------------
+    def sync(self):
 
-def write_m3u( flist , outfile=None , sort=False, rand=False ):
+        """ store the marked directories and commit, staying open ( --watch ) """
 
-    """ write out the M3U-EX info  from the mp3 files
+        with self.lock:
+            self.store_dirs()
+            self.stamp_hits()
 
-    Args:
-       flist (string): a list of filenames (mp3 or flac)
+            self.pending = 0
+            self.db.commit()
 
-    Returns:
-        None
+    def close(self):
 
-    """
-    global album_name_g
+        """ stamp the rows used, evict the oldest and write it all out """
 
-    duration = 0
+        self.sync()
 
-    def dur(sec):
+        with self.lock:
+            count = self.db.execute( "SELECT COUNT(*) FROM meta" ).fetchone()[0]
 
-        sec  = sec.replace(',', ':')
-        #print("sec", sec)
-        dur = sec.split(":")
-        #print("DUR:", dur)
-        
-        dur = dur[1]
+            if count > self.max_entries:
+                self.db.execute( "DELETE FROM meta WHERE path IN"
+                                 " ( SELECT path FROM meta ORDER BY used LIMIT ? )",
+                                 ( count - self.max_entries, ) )
+            self.db.commit()
+            self.db.close()
 
-        if (PY3):
-            dur  = round ( float(dur), 0 )
-        else:
-            dur = int(float(dur)) 
-            
-        
-        return dur
 
-    
-    out = ""
+def open_cache(mode="on"):
 
-    # redirect stdout to file.
-    # this is for compatibility between python 2 and 3
-    if outfile:
-        try:
-            f = open(outfile, 'w')
-            sys.stdout = f
-        except IOError as io:
+    """ open the metadata cache
 
-            fatal( "[error opening %s for writing: %s]\n" % (outfile , io), io.errno)
+    Args:
+        mode(string): "on", "off" ( --no-cache ) or "rebuild" ( --rebuild-cache )
 
-    print ("#EXTM3U\n")
+    Returns:
+        (MetaCache): the cache or None if it is off or can't be used
 
-    if sort:
-        #  sys.stderr.write("[sorting flist in write_m3u")
-        flist.sort()
-    
-    if rand:
-        print ("# SHUFFLED LIST")
+"""
+
+    if mode == "off":
+        return None
+
+    if sqlite3 is None:
+        if not quiet_g:
+            warning( "no sqlite3 module, running without a cache" )
+        return None
+
+    try:
+        return MetaCache( cache_file(), rebuild=(mode == "rebuild") )
+
+    except (OSError, sqlite3.Error) as err:
+        if not quiet_g:
+            warning( ("metadata cache disabled: %s" % err) )
+
+        return None
+
+
+#-----------------------------
+class Track(object):
+
+    """ what the readers and tools found out about one audio file
+
+    seconds is -1 when the length couldn't be found, and approx is
+    set when it was estimated rather than read ( --fast ).
+
+    """
+
+    __slots__ = ( "path", "artist", "title", "album", "date", "seconds", "approx" )
+
+    def __init__(self, path, artist="", title="", album="", date="", seconds=-1,
+                 approx=False):
+        self.path = path
+        self.artist = artist
+        self.title = title
+        self.album = album
+        self.date = date
+        self.seconds = seconds
+        self.approx = approx
+
+
+    def fields(self):
+
+        """ (artist, title, album, date, seconds), as the cache stores them """
+
+        return ( self.artist, self.title, self.album, self.date, self.seconds )
+
+
+def make_entry(track, name=None):
+
+    """ turn a track into a M3U-EX entry
+
+    Args:
+        track(Track):   the file and its tags
+        name(string):   what the entry calls the file, if not track.path
+
+    Returns:
+        (string): a M3U-EX  entry for the file
+
+"""
+
+    return ( "#EXTINF:" + str(track.seconds) + ( ' approx="1"' if track.approx else "" )
+             + "," + track.artist + " - " + track.title + "\n" + ( name or track.path ) )
+
+
+#-----------------------------
+READ_CHUNK = 4096       # least read from a file at once: a page
+READ_BUFFER = 1 << 17   # each thread's buffer; bigger reads go around it
+TAG_BUDGET = 1 << 20    # flac comment blocks past this are cut short (cover art)
+
+read_buffer_g = threading.local()   # .buf, .view: this thread's buffer
+
+preadv = getattr( os, "preadv", None )          # not on every platform
+fadvise = getattr( os, "posix_fadvise", None )
+
+
+class AudioFile(object):
+
+    """ an audio file opened for the in-process readers
+
+    The readers want a few KB from the head of a file and sometimes
+    its tail, never the audio in between.  Reads go through a buffer
+    kept per thread and refilled with os.preadv() a page or so at a
+    time wherever the reader looks, so a seek over cover art or audio
+    costs nothing.  The kernel is told not to read ahead
+    ( POSIX_FADV_RANDOM ) and to drop the pages read once the file is
+    closed ( POSIX_FADV_DONTNEED ), so a scan of the library doesn't
+    push out what a music server has in the page cache.
+
+    It does the read(), seek() and tell() of a binary file, and pread()
+    and unpack() at an offset without moving.  A thread has one open
+    at a time, as they share its buffer.
+
+    """
+
+    def __init__(self, name, chunk=READ_CHUNK):
+
+        self.name = name
+        self.chunk = chunk              # least read at once
+        self.fd = os.open( name, os.O_RDONLY )
+
+        try:
+            self.size = os.fstat( self.fd ).st_size
+            if fadvise:
+                fadvise( self.fd, 0, 0, os.POSIX_FADV_RANDOM )
+        except OSError:
+            os.close( self.fd )
+            raise
+
+        if not hasattr( read_buffer_g, "buf" ):
+            read_buffer_g.buf = bytearray( READ_BUFFER )
+            read_buffer_g.view = memoryview( read_buffer_g.buf )
+
+        self.buf, self.view = read_buffer_g.buf, read_buffer_g.view
+        self.start = self.length = 0    # the part of the file in buf
+        self.pos = 0
+        self.spans = []                 # ( offset, length ) of each read
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+    def close(self):
+
+        """ drop the pages read from the page cache and close the file """
+
+        if self.fd < 0:
+            return
+
+        if fadvise:
+            for offset, length in self.spans:
+                fadvise( self.fd, offset, length, os.POSIX_FADV_DONTNEED )
+
+        os.close( self.fd )
+        self.fd = -1
+
+        if stats_g:
+            stats_g.read( sum( length for offset, length in self.spans ) )
+
+
+    def fill(self, pos, n):
+
+        """ read the buffer full from pos: at least n bytes, if there are """
+
+        length = max( 0, min( max( n, self.chunk ), READ_BUFFER, self.size - pos ) )
+
+        if preadv:
+            got = preadv( self.fd, [ self.view[:length] ], pos )
+        else:
+            data = os.pread( self.fd, length, pos )
+            got = len(data)
+            self.buf[:got] = data
+
+        self.start, self.length = pos, got
+        self.spans.append( ( pos, got ) )
+
+
+    def pread(self, pos, n):
+
+        """ up to n bytes from offset pos, leaving the position alone """
+
+        off = pos - self.start
+
+        if off < 0 or off + n > self.length:
+            if n > READ_BUFFER:     # a big tag block, read it straight through
+                data = os.pread( self.fd, n, pos )
+                self.spans.append( ( pos, len(data) ) )
+                return data
+
+            self.fill( pos, n )
+            off = 0
+
+        return bytes( self.view[ off : min( off + n, self.length ) ] )
+
+
+    def unpack(self, fmt, pos):
+
+        """ struct.unpack() straight out of the buffer at offset pos
+
+        Raises:
+            struct.error: the file ends too soon
+
+        """
+
+        n = struct.calcsize( fmt )
+        off = pos - self.start
+
+        if off < 0 or off + n > self.length:
+            self.fill( pos, n )
+            off = 0
+            if n > self.length:
+                raise struct.error( "file ends at %d, wanted %d bytes at %d" % ( self.size, n, pos ) )
+
+        return struct.unpack_from( fmt, self.buf, off )
+
+
+    def read(self, n):
+        data = self.pread( self.pos, n )
+        self.pos += len(data)
+        return data
+
+
+    def seek(self, offset, whence=0):
+
+        pos = ( 0, self.pos, self.size )[whence] + offset
+        if pos < 0:
+            raise OSError( EINVAL, "%s: seek before the start" % self.name )
+
+        self.pos = pos
+        return pos
+
+
+    def tell(self):
+        return self.pos
+
+
+#-----------------------------
+def skip_id3v2(f):
+
+    """ step over an ID3v2 tag at the start of a file
+
+    Some rippers put one in front of flac streams too.
+
+    Args:
+        f(file): audio file opened for binary reading
+
+    Returns:
+        (int): the offset of the data after the tag (0 if there is none)
+
+"""
+
+    f.seek(0)
+    head = f.read(10)
+
+    if len(head) == 10 and head[:3] == b"ID3":
+        size = syncsafe( head[6:10] ) + 10
+        if head[5] & 0x10:      # footer present
+            size += 10
+        f.seek(size)
+        return size
+
+    f.seek(0)
+    return 0
+
+
+def syncsafe(b):
+
+    """ decode a 28 bit ID3v2 "syncsafe" integer """
+
+    return (b[0] & 0x7f) << 21 | (b[1] & 0x7f) << 14 | (b[2] & 0x7f) << 7 | (b[3] & 0x7f)
+
+
+def vorbis_comments(data):
+
+    """ pick artist, title, album and date out of a vorbis comment block
+
+    flac VORBIS_COMMENT blocks and ogg comment headers share the layout:
+    vendor string, comment count, then KEY=value strings, all with
+    little-endian 32 bit lengths.
+
+    Args:
+        data(bytes): the comment block, starting at the vendor length
+
+    Returns:
+        (dict): lower case tag name -> first value; if the block is
+                cut short, whatever came before the cut
+
+"""
+
+    tags = {}
+
+    try:
+        vendor, = struct.unpack_from( "<I", data, 0 )
+        pos = 4 + vendor
+        count, = struct.unpack_from( "<I", data, pos )
+        pos += 4
+
+        for n in range(count):
+            length, = struct.unpack_from( "<I", data, pos )
+            pos += 4
+            comment = data[pos:pos + length].decode('utf-8', 'replace')
+            pos += length
+
+            key, eq, value = comment.partition('=')
+            key = key.lower()
+            if eq and key in ( "artist", "title", "album", "date" ) and key not in tags:
+                tags[key] = value
+
+    except struct.error:
+        pass
+
+    return tags
+
+
+def read_flac(flacfile):
+
+    """ read STREAMINFO and VORBIS_COMMENT straight from a flac file
+
+    Only the metadata blocks at the head of the file are read; pictures
+    and padding are skipped over and the audio is never touched.  A
+    comment block holding cover art is cut short at TAG_BUDGET, or with
+    --fast at FAST_HEAD, past which no more blocks are looked at.
+
+    Args:
+        flacfile(string): name of a flac audio file
+
+    Returns:
+        (Track): the file's tags and length
+
+    Raises:
+       OSError: file access problems
+       ValueError: not a flac file or broken metadata
+
+"""
+
+    sample_rate = total_samples = None
+    tags = None
+
+    with AudioFile( flacfile, FAST_HEAD if fast_g else READ_CHUNK ) as f:
+
+        skip_id3v2(f)
+
+        if f.read(4) != b"fLaC":
+            raise ValueError( "%s: not a flac file" % flacfile )
+
+        last = False
+
+        while not last and ( sample_rate is None or tags is None ):
+
+            if fast_g and sample_rate and f.tell() >= FAST_HEAD:
+                break
+
+            head = f.read(4)
+            if len(head) < 4:
+                break
+
+            last = bool( head[0] & 0x80 )
+            kind = head[0] & 0x7f
+            length = head[1] << 16 | head[2] << 8 | head[3]
+
+            if kind == 0:       # STREAMINFO
+                block = f.read( length )
+                if len(block) < 18:
+                    raise ValueError( "%s: short STREAMINFO" % flacfile )
+
+                packed, = struct.unpack_from( ">Q", block, 10 )
+                sample_rate   = packed >> 44
+                total_samples = packed & 0xfffffffff
+
+            elif kind == 4:     # VORBIS_COMMENT
+                budget = FAST_HEAD - f.tell() if fast_g else TAG_BUDGET
+                tags = vorbis_comments( f.pread( f.tell(), min( length, budget ) ) )
+                f.seek( length, 1 )
+
+            else:
+                f.seek( length, 1 )
+
+    if not sample_rate:
+        raise ValueError( "%s: no STREAMINFO" % flacfile )
+
+    tags = tags or {}
+    secs = int( round( total_samples / float(sample_rate) ) )
+
+    return Track( flacfile, tags.get("artist", ""), tags.get("title", ""),
+                  tags.get("album", ""), tags.get("date", ""), secs )
+
+
+#-----------------------------
+def metaflac_info( flacfile):
+    
+    
+    """ run metaflac on a flac file
+
+    Args:
+        flacfile(string): name of a flac audio file
+
+    Returns:
+        (Track): the file's tags and length, or None
+
+    Raises:
+       OSError: file access problems
+       ValueError: data not in proper format in flac file
+
+"""
+
+    mf    = tool_path("metaflac")
+    sr    = "--show-sample-rate"
+    bps   = "--show-bps"
+    tots  = "--show-total-samples"
+    art   = "--show-tag=artist"
+    tit   = "--show-tag=title"
+    alb   = "--show-tag=album"
+    dat   = "--show-tag=date"
+
+    mfcmd = [ mf, tit, art, alb, sr, tots, dat, flacfile ]
+
+
+    flacexists = os.path.exists ( flacfile )
+
+    if not flacexists:
+        return None
+    else:
+        try:
+            databytes, err = run_tool( mfcmd )
+
+            data = tool_text( databytes )
+            info = data.split('\n')
+
+            title  = info[0].split('=')[1]
+            artist = info[1].split('=')[1]
+            album  = info[2].split('=')[1]
+
+            sample_rate  =  int(info[3])
+            total_samples = int(info[4])
+
+            date  = info[5].split('=')[1]
+
+            secs = int( round( total_samples / sample_rate ) )
+
+            return Track( flacfile, artist, title, album, date, secs )
+        
+        except OSError as oserr:
+            if not quiet_g: 
+                warning(( str(oserr) ))
+
+        except ValueError as valerr:
+            if not quiet_g:
+                warning(( str(valerr) ))
+
+
+
+
+def metaflac_batch( flacfiles):
+
+    """ run metaflac once over many flac files
+
+    With --with-filename every output line starts with "<file>:",
+    and the lines come grouped by file in the order given.
+
+    Args:
+        flacfiles(list): names of flac audio files
+
+    Returns:
+        (dict): file name -> Track
+                for each file metaflac could read
+
+"""
+
+    mfcmd = [ tool_path("metaflac"), "--with-filename",
+              "--show-sample-rate", "--show-total-samples",
+              "--show-tag=artist", "--show-tag=title",
+              "--show-tag=album", "--show-tag=date" ] + list(flacfiles)
+
+    found = {}
+
+    try:
+        databytes, err = run_tool( mfcmd )
+
+    except OSError as oserr:
+        if not quiet_g:
+            warning(( str(oserr) ))
+        return found
+
+    numbers = [ [] for f in flacfiles ]
+    tags    = [ {} for f in flacfiles ]
+    i = 0
+
+    for line in tool_text( databytes, 'replace' ).split('\n'):
+
+        # a file metaflac could not read has no lines, so look ahead
+        for j in range( i, len(flacfiles) ):
+            if line.startswith( flacfiles[j] + ":" ):
+                i = j
+                break
+        else:
+            continue
+
+        value = line[ len(flacfiles[i]) + 1: ]
+        key, eq, tag = value.partition('=')
+
+        if eq:
+            tags[i].setdefault( key.lower(), tag )
+        elif value.isdigit():
+            numbers[i].append( int(value) )
+
+    for flacfile, n, t in zip( flacfiles, numbers, tags ):
+
+        # sample rate, then total samples
+        if len(n) == 2 and n[0]:
+            secs = int( round( n[1] / float(n[0]) ) )
+            found[flacfile] = Track( flacfile, t.get("artist", ""), t.get("title", ""),
+                                     t.get("album", ""), t.get("date", ""), secs )
+
+    return found
+
+
+#---------------------------
+# ID3v2 text frames we want, by tag version
+ID3_FRAMES = {
+    2: { "TP1": "artist", "TT2": "title", "TAL": "album", "TYE": "date" },
+    3: { "TPE1": "artist", "TIT2": "title", "TALB": "album", "TYER": "date", "TDRC": "date" },
+    4: { "TPE1": "artist", "TIT2": "title", "TALB": "album", "TDRC": "date", "TYER": "date" },
+}
+
+# kbit/s by [mpeg1?][layer][index]
+MP3_BITRATES = {
+    True:  { 1: (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+             2: (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+             3: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320) },
+    False: { 1: (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+             2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+             3: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160) },
+}
+
+# Hz by mpeg version bits
+MP3_RATES = { 3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000) }
+
+
+def id3_text(frame):
+
+    """ decode the first string of an ID3v2 text frame """
+
+    if not frame:
+        return ""
+
+    enc, body = frame[0], frame[1:]
+
+    if enc == 0:
+        text = body.decode('latin-1')
+    elif enc == 1:
+        text = body.decode('utf-16', 'replace')
+    elif enc == 2:
+        text = body.decode('utf-16-be', 'replace')
+    else:
+        text = body.decode('utf-8', 'replace')
+
+    return text.split('\x00')[0].strip()
+
+
+def read_id3v2(f, limit=None):
+
+    """ read the artist, title, album and date frames of an ID3v2 tag
+
+    Frames we don't want (pictures, lyrics) are seeked over.
+
+    Args:
+        f(file): mp3 file opened for binary reading
+        limit(int): look at no frames past this offset ( --fast )
+
+    Returns:
+        (dict, int): the tags found and the offset just past the tag
+
+"""
+
+    tags = {}
+
+    f.seek(0)
+    head = f.read(10)
+
+    if len(head) < 10 or head[:3] != b"ID3":
+        return tags, 0
+
+    major, flags = head[3], head[5]
+    after = end = 10 + syncsafe( head[6:10] )
+    if flags & 0x10:
+        after += 10
+
+    if limit:
+        end = min( end, limit )
+
+    wanted = ID3_FRAMES.get( major )
+
+    if wanted is None:      # unknown version, just step over it
+        return tags, after
+
+    if flags & 0x80 and major < 4:
+        # whole tag unsynchronised: undo it in memory, it is rare
+        body = f.read( end - 10 ).replace( b"\xff\x00", b"\xff" )
+        read_id3v2_frames( io.BytesIO( body ), major, wanted, tags, len(body) )
+
+    else:
+        if flags & 0x40:    # extended header
+            ext = f.read(4)
+            if len(ext) < 4:    # cut short, no frames to read
+                return tags, after
+            if major == 4:
+                f.seek( syncsafe(ext) - 4, 1 )
+            else:
+                f.seek( struct.unpack( ">I", ext )[0], 1 )
+
+        read_id3v2_frames( f, major, wanted, tags, end )
+
+    return tags, after
+
+
+def read_id3v2_frames(f, major, wanted, tags, end):
+
+    """ walk the frames of an ID3v2 tag up to end, filling tags """
+
+    idlen, hlen = ( 3, 6 ) if major == 2 else ( 4, 10 )
+
+    while f.tell() + hlen <= end and len(tags) < 4:
+
+        head = f.read( hlen )
+        if len(head) < hlen or head[0] == 0:      # padding
+            break
+
+        fid = head[:idlen].decode('latin-1')
+
+        if major == 2:
+            size = head[3] << 16 | head[4] << 8 | head[5]
+        elif major == 4:
+            size = syncsafe( head[4:8] )
+        else:
+            size, = struct.unpack( ">I", head[4:8] )
+
+        key = wanted.get( fid )
+
+        if not key or key in tags:
+            f.seek( size, 1 )
+            continue
+
+        frame = f.read( size )
+
+        if major == 4:
+            fmt = head[9]
+            if fmt & 0x0c:      # compressed or encrypted
+                continue
+            if fmt & 0x02:
+                frame = frame.replace( b"\xff\x00", b"\xff" )
+            if fmt & 0x01:      # data length indicator
+                frame = frame[4:]
+
+        tags[key] = id3_text( frame )
+
+
+def read_id3v1(f):
+
+    """ read an ID3v1 tag from the last 128 bytes of a file
+
+    Returns:
+        (dict): the tags found, empty if there is no tag
+
+"""
+
+    tags = {}
+
+    f.seek( -128, 2 )
+    tag = f.read( 128 )
+
+    if tag[:3] != b"TAG":
+        return tags
+
+    for key, start, stop in ( ("title", 3, 33), ("artist", 33, 63),
+                              ("album", 63, 93), ("date", 93, 97) ):
+        value = tag[start:stop].split(b"\x00")[0].decode('latin-1').strip()
+        if value:
+            tags[key] = value
+
+    return tags
+
+
+def mp3_frame(head):
+
+    """ decode a MPEG audio frame header
+
+    Args:
+        head(bytes): 4 bytes that may be a frame header
+
+    Returns:
+        (tuple): (mpeg1, layer, kbit/s, Hz, mono) or None if it isn't one
+
+"""
+
+    if head[0] != 0xff or head[1] & 0xe0 != 0xe0:
+        return None
+
+    version = ( head[1] >> 3 ) & 3
+    layer   = 4 - ( ( head[1] >> 1 ) & 3 )
+    bitrate = head[2] >> 4
+    rate    = ( head[2] >> 2 ) & 3
+
+    if version == 1 or layer == 4 or bitrate in (0, 15) or rate == 3:
+        return None
+
+    mpeg1 = version == 3
+
+    return ( mpeg1, layer, MP3_BITRATES[mpeg1][layer][bitrate],
+             MP3_RATES[version][rate], head[3] >> 6 == 3 )
+
+
+MP3_HEADER_SPAN = 192   # bytes from a frame's start past its Xing/VBRI header
+
+
+def mp3_first_frame(window):
+
+    """ find the first mpeg audio frame header in a block of the file
+
+    Returns:
+        (int, tuple): its offset and what mp3_frame() made of it, or
+                      ( -1, None ) if there isn't one
+
+    """
+
+    pos = window.find( b"\xff" )
+
+    while pos >= 0 and pos + 4 <= len(window):
+        frame = mp3_frame( window[pos:pos + 4] )
+        if frame:
+            return pos, frame
+        pos = window.find( b"\xff", pos + 1 )
+
+    return -1, None
+
+
+def read_mp3(mp3file):
+
+    """ read tags and duration straight from an mp3 file
+
+    Tags come from ID3v2.2/2.3/2.4 frames with ID3v1 filling the gaps.
+    The duration comes from the Xing/Info or VBRI header of the first
+    frame, or failing that from the first frame's bitrate and the file
+    size; the rest of the frames are never read.  With --fast only the
+    frames in the first FAST_HEAD bytes count, the ID3v1 tag at the
+    end is never read, and a length from the bitrate is marked approx.
+
+    Args:
+        mp3file(string): name of a mp3 audio file
+
+    Returns:
+        (Track): the file's tags and length
+
+    Raises:
+       OSError: file access problems
+       ValueError: no mpeg audio frame found
+
+"""
+
+    with AudioFile( mp3file, FAST_HEAD if fast_g else READ_CHUNK ) as f:
+
+        size = f.size
+
+        try:
+            tags, start = read_id3v2( f, FAST_HEAD if fast_g else None )
+        except (struct.error, IndexError) as err:
+            raise ValueError( "%s: broken ID3v2 tag: %s" % (mp3file, err) )
+
+        v1 = read_id3v1(f) if size >= 128 and not fast_g else {}
+        for key, value in v1.items():
+            tags.setdefault( key, value )
+
+        # the first frame is almost always right after the tag; look
+        # further only if it isn't, or its Xing header is cut off
+        for budget in ( READ_CHUNK, 65536 ):
+            window = f.pread( start, budget )
+            pos, frame = mp3_first_frame( window )
+            if len(window) < budget or ( frame and pos + MP3_HEADER_SPAN <= len(window) ):
+                break
+
+    if not frame:
+        raise ValueError( "%s: no mpeg audio frame found" % mp3file )
+
+    mpeg1, layer, kbps, rate, mono = frame
+
+    if layer == 1:
+        samples = 384
+    elif layer == 2 or mpeg1:
+        samples = 1152
+    else:
+        samples = 576
+
+    if mpeg1:
+        side = 17 if mono else 32
+    else:
+        side = 9 if mono else 17
+
+    frames = 0
+    xing = pos + 4 + side
+
+    try:
+        if window[xing:xing + 4] in ( b"Xing", b"Info" ):
+            flags, = struct.unpack_from( ">I", window, xing + 4 )
+            if flags & 1:
+                frames, = struct.unpack_from( ">I", window, xing + 8 )
+
+        elif window[pos + 36:pos + 40] == b"VBRI":
+            frames, = struct.unpack_from( ">I", window, pos + 50 )
+
+    except struct.error:    # header cut short, go by the bitrate
+        frames = 0
+
+    if frames:
+        secs = frames * samples / float(rate)
+    else:
+        audio = size - start - pos - ( 128 if v1 else 0 )
+        secs = audio * 8 / ( kbps * 1000.0 )
+
+    return Track( mp3file, tags.get("artist", ""), tags.get("title", ""),
+                  tags.get("album", ""), tags.get("date", ""), int( round(secs) ),
+                  fast_g and not frames )
+
+
+#---------------------------
+def mp3info_info( mp3file):
+
+    """ run mp3info on an mp3 file
+
+    Args:
+        mp3file(string): name of a mp3 audio file
+
+    Returns:
+        (Track): the file's tags and length, or None
+
+    Raises:
+       OSError: file access problems
+       ValueError: data not in proper format in mp3 file
+
+
+   Note:
+       "<file>  does not have an ID3 1.x tag" is an error that comes
+        if file has no  ID3v1 tag. It may have and IDv2 tag, though,
+        and be perfectly legitimate. Try using a tagging program
+        like mp3tag (windows, works with wine on linux) to copy the id3v2
+        tag to an id3v1 tag and it will work. or the tags might actually be
+        missing. This function tries to get the data from the file name if so.
+
+"""
+
+    # ver = "%v"
+    # sr  = "%Q"
+    # bps = "%r"
+    # frames = "%u"
+    # art   = "%a"
+    # tit   = "%t"
+    # alb   = "%l"
+    # dat   = "%y"
+    
+    mp    = tool_path("mp3info")
+
+
+    mp3exists = os.path.exists ( mp3file )
+
+    options = "%a\n%t\n%l\n%y\n%S\n"
+
+    output = None
+
+    if not mp3exists:
+        return None
+    else:
+        try:
+
+            infobytes, err = run_tool( [mp, "-p", options,  mp3file ] )
+            info = tool_text( infobytes )
+            info =  info.split('\n')
+
+            artist =  info[0]
+            title  =  info[1]
+            album  =  info[2]
+            year   =  info[3]
+            secs   =  int(info[4])
+
+            output = Track( mp3file, artist, title, album, year, secs )
+
+        except OSError as o:
+            if not quiet_g:
+                warning(( str(o) ))
+
+        except ValueError as v:
+            if not quiet_g:
+                warning(( str(v) ))
+
+    return output
+
+def mp3info_batch( mp3files):
+
+    """ run mp3info once over many mp3 files
+
+    Each file gives one tab separated line that starts with its name.
+
+    Args:
+        mp3files(list): names of mp3 audio files
+
+    Returns:
+        (dict): file name -> Track
+                for each file mp3info could read
+
+"""
+
+    options = "%F\t%a\t%t\t%l\t%y\t%S\n"
+
+    found = {}
+    wanted = set( mp3files )
+
+    try:
+        infobytes, err = run_tool( [ tool_path("mp3info"), "-p", options ] + list(mp3files) )
+
+    except OSError as o:
+        if not quiet_g:
+            warning(( str(o) ))
+        return found
+
+    for line in tool_text( infobytes, 'replace' ).split('\n'):
+
+        info = line.split('\t')
+
+        if len(info) != 6 or info[0] not in wanted:
+            continue
+
+        mp3file, artist, title, album, year, secs = info
+
+        try:
+            found[mp3file] = Track( mp3file, artist, title, album, year, int(secs) )
+
+        except ValueError as v:
+            if not quiet_g:
+                warning(( "%s: %s" % (mp3file, v) ))
+
+    return found
+
+
+#---------------------------
+# ilst items we want
+MP4_ITEMS = { b"\xa9nam": "title", b"\xa9ART": "artist",
+              b"\xa9alb": "album", b"\xa9day": "date" }
+
+
+def mp4_boxes(f, start, end):
+
+    """ walk the boxes (atoms) between two offsets of a mp4 file
+
+    Only the 8 or 16 byte box headers are looked at, so passing over
+    mdat costs nothing.
+
+    Args:
+        f(AudioFile): the mp4 file
+        start(int): offset of the first box
+        end(int):   offset just past the last box
+
+    Yields:
+        (bytes, int, int): box type, offset of its payload, offset past its end
+
+    Raises:
+       ValueError: a box runs past its parent
+
+"""
+
+    pos = start
+
+    while pos + 8 <= end:
+
+        size, kind = f.unpack( ">I4s", pos )
+        payload = pos + 8
+
+        if size == 1:       # 64 bit size follows the type
+            size, = f.unpack( ">Q", payload )
+            payload += 8
+        elif size == 0:     # runs to the end of the file
+            size = end - pos
+
+        if size < payload - pos or pos + size > end:
+            raise ValueError( "bad mp4 box %r at %d" % (kind, pos) )
+
+        yield kind, payload, pos + size
+
+        pos += size
+
+
+def mp4_find(f, start, end, kind):
+
+    """ the payload span of the first box of a type, or None """
+
+    for k, payload, stop in mp4_boxes( f, start, end ):
+        if k == kind:
+            return payload, stop
+
+    return None
+
+
+def read_m4a(m4afile):
+
+    """ read tags and duration straight from an m4a (itunes) file
+
+    The box tree is walked to moov/mvhd for the duration and
+    moov/udta/meta/ilst for the ©nam, ©ART, ©alb and ©day items, so
+    only the pages holding those and the box headers on the way are
+    ever read.
+
+    Args:
+        m4afile(string): name of a m4a audio file
+
+    Returns:
+        (Track): the file's tags and length
+
+    Raises:
+       OSError: file access problems
+       ValueError: not a mp4 file or broken boxes
+
+"""
+
+    tags = {}
+
+    with AudioFile( m4afile ) as f:
+
+        try:
+            end = f.size
+
+            moov = mp4_find( f, 0, end, b"moov" )
+            if not moov:
+                raise ValueError( "%s: no moov box" % m4afile )
+
+            mvhd = mp4_find( f, moov[0], moov[1], b"mvhd" )
+            if not mvhd:
+                raise ValueError( "%s: no mvhd box" % m4afile )
+
+            pos = mvhd[0]
+            if f.unpack( ">B", pos )[0] == 1:
+                scale, length = f.unpack( ">IQ", pos + 20 )
+            else:
+                scale, length = f.unpack( ">II", pos + 12 )
+
+            if not scale:
+                raise ValueError( "%s: mvhd has no timescale" % m4afile )
+
+            secs = int( round( length / float(scale) ) )
+
+            udta = mp4_find( f, moov[0], moov[1], b"udta" )
+            meta = udta and mp4_find( f, udta[0], udta[1], b"meta" )
+
+            if meta:
+                pos = meta[0]
+                # meta is a full box (4 bytes of version and flags) except
+                # in some quicktime files, which go straight to hdlr
+                if f.pread( pos + 4, 4 ) != b"hdlr":
+                    pos += 4
+
+                ilst = mp4_find( f, pos, meta[1], b"ilst" )
+
+                for kind, payload, stop in mp4_boxes( f, *ilst ) if ilst else ():
+
+                    key = MP4_ITEMS.get( kind )
+                    if not key or key in tags:
+                        continue
+
+                    data = mp4_find( f, payload, stop, b"data" )
+                    if data:
+                        # 4 bytes type, 4 bytes locale, then the value
+                        tags[key] = f.pread( data[0] + 8, data[1] - data[0] - 8 ).decode('utf-8', 'replace')
+
+        except struct.error as err:
+            raise ValueError( "%s: %s" % (m4afile, err) )
+
+    return Track( m4afile, tags.get("artist", ""), tags.get("title", ""),
+                  tags.get("album", ""), tags.get("date", ""), secs )
+
+
+#---------------------------
+def mp4info_info( m4afile):
+
+    """ run mp4info on an m4a (itunes)  file
+
+    Args:
+        m4afile(string): name of a m4a audio file
+
+    Returns:
+        (Track): the file's tags and length, or None
+
+    Raises:
+       OSError:    file access problems
+       ValueError: data not in proper format in m4a file
+
+"""
+# mp4info output:
+#
+# 01 J.S. Bach - English Suite N.2 Bourree 1.m4a:
+# Track	Type	Info
+# 1	audio	alac, 102.000 secs, 875 kbps, 44100 Hz
+#  Name: J.s. Bach - English Suite N.2: Bourree 1
+#  Artist: Eddy Antonini
+#  Sort Artist: Eddy Antonini
+#  Encoded with: qaac 0.47, QuickTime 7.6.9
+#  Release Date: 1998
+#  Album: When Water Became Ice
+#  Sort Album: When Water Became Ice
+#  Track: 1 of 12
+#  Genre: Power Metal
+#  Cover Art pieces: 1
+#  Album Artist: Eddy Antonini
+#  Sort Album Artist: Eddy Antonini
+#  Lyrics:
+#  [instrumental]
+
+    mp4info    = tool_path("mp4info")
+    artist = ""
+    title  = ""
+    album = ""
+    date = ""
+    secs   = 0
+
+
+    m4aexists = os.path.exists ( m4afile )
+
+    samples_per_frame = 0
+    secs = -1
+
+    if not m4aexists:
+        return None
+    else:
+        try:
+
+            mp4_infobytes, err = run_tool( [mp4info,  m4afile ], stderr=True )
+
+            info = tool_text( mp4_infobytes )
+
+            m4ainfo = info.split('\n')
+
+            for entry in m4ainfo:
+
+                # match whole keys so "Sort Artist" and "Album Artist"
+                # don't pass for "Artist"
+                key, colon, value = entry.strip().partition(':')
+                value = value.strip()
+
+                if colon and key == "Artist":
+                    artist = value
+
+                if colon and key in ( "Name", "Title" ):
+                    title = value
+
+                if colon and key == "Album":
+                    album = value
+
+                if colon and key == "Release Date":
+                    date = value
+
+                if "secs" in entry.lower():
+                    s = entry.split(',')
+                    s = s[1].split()[0]
+                    secs = int(round(float(s)))
+
+        except OSError as o:
+            if not quiet_g:
+                warning(( str(o) ))
+
+        except ValueError as v:
+            if not quiet_g:
+                warning(( str(v) ))
+
+        return Track( m4afile, artist, title, album, date, secs )
+
+
+#---------------------------
+OGG_MAX_HEADER = 1 << 20    # comment packets past this are cut short (cover art)
+
+
+def ogg_packets(f, count, limit=OGG_MAX_HEADER):
+
+    """ read the first packets of the first logical stream of an ogg file
+
+    Args:
+        f(file):    ogg file opened for binary reading
+        count(int): number of packets wanted
+        limit(int): longest packet kept whole
+
+    Returns:
+        (int, list): the stream serial number and the packets (bytes);
+                     a packet longer than limit is cut short
+
+    Raises:
+       ValueError: not an ogg file or it ends too soon
+
+"""
+
+    serial = None
+    packets = []
+    part = []
+    partlen = 0
+
+    while len(packets) < count:
+
+        head = f.read(27)
+        if len(head) < 27 or head[:4] != b"OggS":
+            raise ValueError( "not an ogg file or header pages missing" )
+
+        lacing = f.read( head[26] )
+        body = f.read( sum( bytearray(lacing) ) )
+
+        page_serial, = struct.unpack_from( "<I", head, 14 )
+
+        if serial is None:
+            serial = page_serial
+        elif page_serial != serial:     # some other multiplexed stream
+            continue
+
+        pos = 0
+        for n in bytearray(lacing):
+            part.append( body[pos:pos + n] )
+            partlen += n
+            pos += n
+
+            if n < 255:
+                packets.append( b"".join( part ) )
+                part = []
+                partlen = 0
+                if len(packets) == count:
+                    break
+
+        if partlen > limit:
+            packets.append( b"".join( part ) )
+            break
+
+    return serial, packets
+
+
+def ogg_last_granule(f, serial, size):
+
+    """ the granule position of the last page of a stream
+
+    A page is never longer than 65307 bytes, so the last one starts
+    somewhere in the final 64k of the file; but it is usually a few KB
+    long, so the last two pages are looked in first.
+
+    Args:
+        f(AudioFile): the ogg file
+        serial(int): stream serial number
+        size(int):   file size
+
+    Returns:
+        (int): the granule position
+
+    Raises:
+       ValueError: no page of the stream found near the end
+
+"""
+
+    for back in ( 2 * READ_CHUNK, 65536 + 27 ):
+
+        back = min( size, back )
+        tail = f.pread( size - back, back )
+
+        pos = tail.rfind( b"OggS" )
+
+        while pos >= 0:
+            if pos + 27 <= len(tail):
+                granule, page_serial = struct.unpack_from( "<qI", tail, pos + 6 )
+                if page_serial == serial and granule >= 0:
+                    return granule
+
+            pos = tail.rfind( b"OggS", 0, pos )
+
+        if back == size:
+            break
+
+    raise ValueError( "no last page found" )
+
+
+def read_ogg(oggfile):
+
+    """ read tags and duration straight from an ogg vorbis or opus file
+
+    The comments come from the header packets on the first pages and
+    the duration from the granule position of the last page, found by
+    seeking near the end, so the audio in between is never read.  With
+    --fast a vorbis file's length is its size over the nominal bitrate
+    of its ident header, marked approx, and the end isn't read at all.
+
+    Args:
+        oggfile(string): name of an ogg or opus audio file
+
+    Returns:
+        (Track): the file's tags and length
+
+    Raises:
+       OSError: file access problems
+       ValueError: not vorbis or opus, or broken pages
+
+"""
+
+    with AudioFile( oggfile, FAST_HEAD if fast_g else READ_CHUNK ) as f:
+
+        size = f.size
+        nominal = 0
+
+        try:
+            serial, ( ident, comment ) = ogg_packets( f, 2, FAST_HEAD if fast_g
+                                                            else OGG_MAX_HEADER )
+
+            if ident[:7] == b"\x01vorbis" and comment[:7] == b"\x03vorbis":
+                rate, nominal = struct.unpack_from( "<I4xi", ident, 12 )
+                skip = 0
+                tags = vorbis_comments( comment[7:] )
+
+            elif ident[:8] == b"OpusHead" and comment[:8] == b"OpusTags":
+                rate = 48000    # opus granules always count 48kHz samples
+                skip, = struct.unpack_from( "<H", ident, 10 )
+                tags = vorbis_comments( comment[8:] )
+
+            else:
+                raise ValueError( "not a vorbis or opus stream" )
+
+            approx = fast_g and nominal > 0
+            if approx:
+                audio = size - f.tell()     # all but the header pages
+            else:
+                granule = ogg_last_granule( f, serial, size )
+
+        except (ValueError, struct.error) as err:
+            raise ValueError( "%s: %s" % (oggfile, err) )
+
+    if not rate:
+        raise ValueError( "%s: no sample rate" % oggfile )
+
+    if approx:
+        secs = int( round( audio * 8 / float(nominal) ) )
+    else:
+        secs = int( round( max( granule - skip, 0 ) / float(rate) ) )
+
+    return Track( oggfile, tags.get("artist", ""), tags.get("title", ""),
+                  tags.get("album", ""), tags.get("date", ""), secs, approx )
+
+
+#---------------------------
+def ogginfo_info( oggfile):
+
+    """ run ogginfo on an ogg vorbis or opus file
+
+    Args:
+        oggfile(string): name of an ogg or opus audio file
+
+    Returns:
+        (Track): the file's tags and length, or None
+
+    Raises:
+       OSError: file access problems
+       ValueError: data not in proper format in ogg file
+
+"""
+    ogg = tool_path("ogginfo")
+    artist = ""
+    title  = ""
+    album = ""
+    date = ""
+    secs   = 0
+
+#    title=Custer's Last Stand
+#    artist=Rick Wakeman
+#    album=Time Machine
+#    genre=Rock
+#    date=1988
+#    tracknumber=01
+# Vorbis stream 1:
+#    Total data length: 3411006 bytes
+#    Playback length: 4m:02.306s
+#    Average bitrate: 112.617702 kb/s
+
+
+    oggexists = os.path.exists ( oggfile )
+
+    samples_per_frame = 0
+    secs = -1
+
+    if not oggexists:
+        return None
+    else:
+        try:
+
+            infobytes, err = run_tool( [ogg, oggfile ] )
+
+            ogginfo = tool_text( infobytes )
+
+            ogginfo = ogginfo.split('\n')
+
+            #print( ogginfo )
+
+            for entry in ogginfo:
+                #print("OGG ENTRY:\t[%s]\n" % entry )
+
+                if not artist:
+                    if "artist" in entry:
+                        artist = entry.split('=')[1].strip()
+
+                if not title:
+                    if "title" in entry:
+                        title = entry.split('=')[1].strip()
+
+                if "album" in entry.lower():
+                    album = entry.split('=')[1].strip()
+
+                if not date:
+                    if "date=" in entry:
+                        date = entry.split('=')[1].strip()
+
+                # Playback length: 8m:37.106s   or  1h:02m:03.500s
+                if "Playback length:" in entry:
+
+                    length = entry.split(':', 1)[1]
+                    secs = 0.0
+
+                    for part in length.strip().split(':'):
+                        if part.endswith('h'):
+                            secs += 3600 * float( part[:-1] )
+                        elif part.endswith('m'):
+                            secs += 60 * float( part[:-1] )
+                        elif part.endswith('s'):
+                            secs += float( part[:-1] )
+
+                    secs = int(round(secs))
+
+        except OSError as o:
+            if not quiet_g:
+                warning(( str(o) ))
+
+        except ValueError as v:
+            if not quiet_g:
+                warning(( str(v) ))
+
+        return Track( oggfile, artist, title, album, date, secs )
+
+
+
+#---------------------
+# how each format is probed:
+#   ( in-process reader, external tool, one-file probe, many-file probe )
+FORMATS = {
+    "flac": ( read_flac, "metaflac", metaflac_info, metaflac_batch ),
+    "mp3":  ( read_mp3,  "mp3info",  mp3info_info,  mp3info_batch ),
+    "m4a":  ( read_m4a,  "mp4info",  mp4info_info,  None ),
+    "ogg":  ( read_ogg,  "ogginfo",  ogginfo_info,  None ),
+}
+
+# file extension -> format
+EXT_FORMATS = { "flac": "flac", "mp3": "mp3", "m4a": "m4a",
+                "ogg": "ogg", "opus": "ogg" }
+
+BACKENDS = ( "auto", "native", "external" )
+
+
+def format_of(entry):
+
+    """ which of the FORMATS a file is, going by its extension
+
+    Args:
+       entry (string): name of an audio file
+
+    Returns:
+        (string): a key of FORMATS or None
+
+    """
+
+    ext = os.path.splitext( entry )[1][1:].lower()
+
+    return EXT_FORMATS.get( ext )
+
+
+def set_backend(spec):
+
+    """ choose how files get probed ( --backend )
+
+    Args:
+       spec (string): "flac=native", "mp3=external", ... or just a
+                      backend name for every format
+
+    Raises:
+       ValueError: unknown format or backend
+
+    """
+
+    fmt, eq, backend = spec.rpartition('=')
+
+    if backend not in BACKENDS:
+        raise ValueError( "backend must be one of %s" % ", ".join(BACKENDS) )
+
+    if not eq:
+        for fmt in FORMATS:
+            backend_g[fmt] = backend
+
+    elif fmt.lower() in EXT_FORMATS:
+        backend_g[ EXT_FORMATS[fmt.lower()] ] = backend
+
+    else:
+        raise ValueError( "unknown format %s" % fmt )
+
+
+def resolve_tools():
+
+    """ look up every external tool in the path, once """
+
+    for reader, tool, single, batch in FORMATS.values():
+        tools_g[tool] = which( tool )
+
+
+def tool_path(tool):
+
+    """ the full path of an external tool, or None if it isn't installed """
+
+    if tool not in tools_g:
+        tools_g[tool] = which( tool )
+
+    return tools_g[tool]
+
+
+class ProbeTimeout(Exception):
+
+    """ an external probe ran too long and was killed
+
+    Not an OSError, so it gets past the probes' own error handling
+    to run_external, which decides whether to retry or skip.
+
+    """
+
+
+def past_deadline():
+    return deadline_at_g is not None and time.monotonic() >= deadline_at_g
+
+
+def tool_text(data, errors='strict'):
+
+    """ what a tool wrote, decoded from UTF-8 ( timed for --stats ) """
+
+    if not stats_g:
+        return data.decode( 'utf-8', errors )
+
+    start = time.perf_counter()
+    try:
+        return data.decode( 'utf-8', errors )
+    finally:
+        stats_g.sample( "decode", time.perf_counter() - start )
+
+
+def run_tool(cmd, stderr=False):
+
+    """ run an external probe, killing it if it runs too long
+
+    It gets --timeout seconds, or what is left before the --deadline
+    if that is sooner.
+
+    Args:
+        cmd(list):          the command line
+        stderr(boolean):    capture standard error too
+
+    Returns:
+        (stdout, stderr): the bytes the tool wrote (stderr None unless
+                          captured)
+
+    Raises:
+        OSError: the tool couldn't be run
+        ProbeTimeout: it ran out of time, or there was none left
+
+    """
+
+    timeout = timeout_g or None
+    why = "killed after %ds" % ( timeout_g )
+
+    if deadline_at_g is not None:
+        left = deadline_at_g - time.monotonic()
+        if left <= 0:
+            raise ProbeTimeout( "past the deadline" )
+        if not timeout or left < timeout:
+            timeout, why = left, "killed at the deadline"
+
+    tool = os.path.basename( cmd[0] )
+    start = time.perf_counter()
+
+    # in a group of its own, so a kill takes any children of the tool too
+    p = subprocess.Popen( cmd, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE if stderr else None,
+                          start_new_session=True )
+
+    if stats_g:
+        started = time.perf_counter()
+        stats_g.sample( "spawn " + tool, started - start )
+
+    try:
+        out = p.communicate( timeout=timeout )
+        if stats_g:
+            stats_g.sample( "run " + tool, time.perf_counter() - started )
+        return out
+
+    except subprocess.TimeoutExpired:
+        try:
+            os.killpg( p.pid, signal.SIGKILL )
+        except OSError:
+            p.kill()
+        p.communicate()
+        raise ProbeTimeout( "%s %s" % ( tool, why ) )
+
+
+def skip(entry, why):
+
+    """ give up on a file, to be listed at the end of the run """
+
+    skipped_g.append( ( entry, str(why) ) )
+
+
+def report_skipped():
+
+    """ list the files given up on, however quiet the run """
+
+    if skipped_g:
+        warning(( "skipped %d file%s:" % ( len(skipped_g), "" if len(skipped_g) == 1 else "s" ) ))
+        for entry, why in skipped_g:
+            sys.stderr.write( "    %s  (%s)\n" % ( entry, why ) )
+
+
+#---------------------
+class Histogram(object):
+
+    """ counts of values in fixed log-scale buckets ( --stats )
+
+    Four buckets to each doubling from least up, 128 in all, so the
+    memory is the same however many values go in and a percentile read
+    back is within an eighth of the true value.  Values below least go
+    in the first bucket, those past the last bucket in the last.
+
+    """
+
+    STEPS = 4
+
+    def __init__(self, least, buckets=128):
+        self.least = least
+        self.buckets = [0] * buckets
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+
+    def add(self, value, n=1):
+        # value / least == m * 2**e, 0.5 <= m < 1
+        m, e = math.frexp( value / self.least )
+        i = ( e - 1 ) * self.STEPS + int( ( m * 2 - 1 ) * self.STEPS )
+        self.buckets[ min( max( i, 0 ), len(self.buckets) - 1 ) ] += n
+        self.count += n
+        self.total += value * n
+        self.max = max( self.max, value )
+
+
+    def percentile(self, q):
+
+        """ the middle of the bucket the q'th value fell in, 0 <= q <= 1 """
+
+        want = max( 1, math.ceil( q * self.count ) )
+        seen = 0
+
+        for i, n in enumerate( self.buckets ):
+            seen += n
+            if seen >= want:
+                low = self.least * 2 ** ( i // self.STEPS ) * ( 1 + ( i % self.STEPS ) / self.STEPS )
+                high = low * ( 1 + 1.0 / ( self.STEPS + i % self.STEPS ) )
+                return min( ( low + high ) / 2, self.max )
+
+        return self.max
+
+
+class Stats(object):
+
+    """ where the time of a run went ( --stats )
+
+    Phases are wall time in the main thread, which is charged to one
+    phase at a time: discovery, probing and output are interleaved
+    when the list is streamed, so each gets only the time spent in its
+    own step, not in the steps it waits on.
+
+    Latencies are per file, from whichever thread did the work: the
+    os.stat(), each in-process reader and each external tool ( a
+    batch run's time is shared out over its files ).  So are the bytes
+    the in-process readers read.  Each tool run is also split into
+    starting the process ( "spawn" ), the tool's own run time and
+    decoding what it wrote ( "decode" ); those are per run, not per
+    file.
+
+    Samples go into Histograms, so a run over a million files costs no
+    more memory than one over ten, and everything is a perf_counter()
+    call and a counter bump: little enough to leave on.
+
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+        self.phases = {}            # name -> seconds, main thread only
+        self.phase = "startup"      # what the main thread is doing
+        self.since = self.start
+        self.latency = {}           # "stat", "native flac", "metaflac" -> Histogram of seconds
+        self.counts = dict.fromkeys( ( "probed", "cached", "reused", "failed", "quarantined" ), 0 )
+        self.reads = Histogram( 1 ) # bytes read from each file by a reader
+
+
+    def enter(self, phase):
+
+        """ charge the main thread's time to phase from now on
+
+        Returns:
+            (string): the phase it was charged to, to go back to
+
+        """
+
+        now = time.perf_counter()
+        was = self.phase
+
+        self.phases[was] = self.phases.get( was, 0.0 ) + now - self.since
+        self.phase, self.since = phase, now
+
+        return was
+
+
+    def count(self, what):
+        with self.lock:
+            self.counts[what] += 1
+
+
+    def sample(self, what, seconds, files=1):
+        with self.lock:
+            latency = self.latency.get( what )
+            if latency is None:
+                latency = self.latency[what] = Histogram( 1e-6 )
+            latency.add( seconds / files, files )
+
+
+    def read(self, nbytes):
+        with self.lock:
+            self.reads.add( nbytes )
+
+
+    def timed(self, phase, iterable):
+
+        """ yield from iterable, charging the time taken by each item to phase """
+
+        it = iter( iterable )
+
+        while True:
+            was = self.enter( phase )
+            try:
+                item = next( it )
+            except StopIteration:
+                return
+            finally:
+                self.enter( was )
+            yield item
+
+
+    def report(self):
+
+        """ the figures as a dict, as --stats-file writes them """
+
+        self.enter( self.phase )
+
+        total = time.perf_counter() - self.start
+        phases = dict( self.phases )
+        phases["total"] = total
+
+        latency = {}
+        for what, h in sorted( self.latency.items() ):
+            latency[what] = { "count": h.count,
+                              "p50_ms": round( h.percentile(0.50) * 1000, 3 ),
+                              "p95_ms": round( h.percentile(0.95) * 1000, 3 ),
+                              "p99_ms": round( h.percentile(0.99) * 1000, 3 ) }
+
+        reads = self.reads
+        read = reads.count and { "files": reads.count,
+                                 "mean": int( reads.total / reads.count ),
+                                 "p50": int( reads.percentile(0.50) ),
+                                 "p99": int( reads.percentile(0.99) ),
+                                 "max": reads.max } or None
+
+        files = sum( self.counts.values() )
+
+        return { "files": files,
+                 "counts": dict( self.counts ),
+                 "cache_hit_rate": round( self.counts["cached"] / float(files), 4 ) if files else None,
+                 "files_per_sec": round( files / total, 1 ) if total else None,
+                 "phases": dict( ( k, round( v, 6 ) ) for k, v in phases.items() ),
+                 "latency": latency,
+                 "bytes_read": read }
+
+
+    def show(self, report, stream):
+
+        """ write a report out for people """
+
+        counts = report["counts"]
+
+        stream.write( "STATS: %d files in %.3fs, %s files/s\n"
+                      % ( report["files"], report["phases"]["total"], report["files_per_sec"] ) )
+        stream.write( "STATS: probed %(probed)d  cached %(cached)d  reused %(reused)d"
+                      "  failed %(failed)d  quarantined %(quarantined)d\n" % counts )
+        if report["cache_hit_rate"] is not None:
+            stream.write( "STATS: cache hit rate %.1f%%\n" % ( report["cache_hit_rate"] * 100 ) )
+
+        stream.write( "STATS: phases  %s\n" % "  ".join( "%s %.3fs" % kv for kv in
+                                                          sorted( report["phases"].items() ) ) )
+
+        for what, l in report["latency"].items():
+            stream.write( "STATS: %-14s %7d  p50 %8.3fms  p95 %8.3fms  p99 %8.3fms\n"
+                          % ( what, l["count"], l["p50_ms"], l["p95_ms"], l["p99_ms"] ) )
+
+        read = report["bytes_read"]
+        if read:
+            stream.write( "STATS: bytes read     %7d  mean %d  p50 %d  p99 %d  max %d\n"
+                          % ( read["files"], read["mean"], read["p50"], read["p99"], read["max"] ) )
+
+
+def finish_stats():
+
+    """ print the stats of the run and write the stats file, if asked for """
+
+    report = stats_g.report()
+
+    stats_g.show( report, sys.stderr )
+
+    if stats_file_g:
+        try:
+            with open( stats_file_g, 'w' ) as f:
+                json.dump( report, f, indent=2, sort_keys=True )
+                f.write( "\n" )
+        except (OSError, IOError) as err:
+            warning(( "--stats-file: %s" % err ))
+
+
+#---------------------
+def hms(sec):
+    """ convert seconds to hms string """
+
+    dhour = int(sec / 3600)
+    dmin = int( (sec/60) - dhour*60 )
+    dsec = int( sec - ( dhour*3600 + dmin*60) )
+    # print ("dhour", dhour)
+    # print ("dmin", dmin)
+    # print ("dsec", dsec)
+
+    h = "{:02d}".format(dhour)
+    m = "{:02d}".format(dmin)
+    s = "{:02d}".format(dsec)
+
+    return  ':'.join( (h, m, s) )
+
+
+#----------------------
+def quick_info(entry, previous=None):
+
+    """ get the tags of a file from the cache or the in-process reader
+
+    Args:
+       entry (string): name of an audio file
+       previous (tuple): ( entries, since ) of a playlist being updated;
+                         its entry is used if the file hasn't changed
+
+    Returns:
+        (track, st, err): the Track or None, os.stat() of the file (None if
+                         it is gone or in quarantine) and the reader's
+                         error if it failed ( QUARANTINED if not tried )
+
+    """
+
+    if cache_g:
+        track = cache_g.known.pop( entry, None )
+        if track:
+            if stats_g:
+                stats_g.count( "cached" )
+            return track, None, None
+
+    start = time.perf_counter()
+
+    try:
+        st = os.stat( entry )
+    except OSError:
+        return None, None, None
+
+    if stats_g:
+        stats_g.sample( "stat", time.perf_counter() - start )
+
+    if previous:
+        entries, since = previous
+        track = entries.get( os.path.normpath(entry) )
+        # ctime, not mtime: a file copied or renamed into place with its
+        # old mtime kept ( cp -p, rsync -a, mv ) still gets a new ctime
+        if track and st.st_ctime_ns <= since:
+            if stats_g:
+                stats_g.count( "reused" )
+            return track, st, None
+
+    if cache_g:
+        track = cache_g.get( entry, st )
+        if track:
+            if stats_g:
+                stats_g.count( "cached" )
+            return track, st, None
+
+        if cache_g.quarantined( entry, st ):
+            if stats_g:
+                stats_g.count( "quarantined" )
+            return fallback_track( entry ), None, QUARANTINED
+
+    fmt = format_of( entry )
+
+    if backend_g.get( fmt ) == "external":
+        return None, st, None
+
+    if past_deadline():
+        skip( entry, "past the deadline" )
+        return None, None, None
+
+    start = time.perf_counter()
+
+    try:
+        track = FORMATS[fmt][0]( entry )
+
+    except (OSError, ValueError) as err:
+        return None, st, err
+
+    finally:
+        if stats_g:
+            stats_g.sample( "native " + fmt, time.perf_counter() - start )
+
+    if stats_g:
+        stats_g.count( "probed" )
+
+    if cache_g and not fast_g:      # estimates would pass for the real thing
+        cache_g.put( entry, st, track )
+
+    return track, st, None
+
+
+QUARANTINED = "quarantined"  # quick_info's err for a file left alone
+
+
+def fallback_track(entry):
+
+    """ what a file that can't be read is listed as with --fallback
+
+    Its name, less any track number, read as "artist - title" if it
+    looks like that and as the title if not.
+
+    Returns:
+        (Track): a track of unknown length, or None without --fallback
+
+    """
+
+    if not fallback_g:
+        return None
+
+    name = os.path.splitext( os.path.basename( entry ) )[0]
+    name = name.lstrip( "0123456789" ).lstrip( " .-_" ) or name
+
+    artist, dash, title = name.rpartition( " - " )
+
+    return Track( entry, artist.strip(), title.strip() )
+
+
+def probe_failed(entry, st, err, tried=True):
+
+    """ note a file nothing could read, so later runs leave it alone
+
+    A file whose probe was killed goes in too, as it would hold up
+    every run; files skipped at the deadline weren't really tried, so
+    they don't.  Nor do files that nothing looked at, the in-process
+    reader being off ( --backend external ) and the tool not installed:
+    the file may well be fine.
+
+    Args:
+       entry (string): name of an audio file
+       st (stat_result): os.stat() of the file before probing
+       err (Exception): why the in-process reader failed, if it did
+       tried (boolean): a reader or tool had the last word on the file
+
+    Returns:
+        (Track): the fallback entry for the file, or None
+
+    """
+
+    if cache_g and tried and not past_deadline():
+        why = [ why for name, why in skipped_g if name == entry ]
+        why = str( why[-1] if why else err or "%s found nothing" % FORMATS[ format_of( entry ) ][1] )
+        if why.startswith( entry + ": " ):
+            why = why[ len(entry) + 2 : ]
+        cache_g.quarantine( entry, st, why )
+
+    return fallback_track( entry )
+
+
+def external_probe(entry, err=None):
+
+    """ which external probe to run on a file the reader couldn't handle
+
+    Args:
+       entry (string): name of an audio file
+       err (Exception): why the in-process reader failed, if it did
+
+    Returns:
+        (function, boolean): the probe and whether it takes a list of
+                             files; None (after a warning) if there is
+                             no tool to fall back on
+
+    """
+
+    fmt = format_of( entry )
+    reader, tool, single, batch = FORMATS[fmt]
+
+    if backend_g.get( fmt ) == "native":
+        if not quiet_g:
+            warning(( str(err) ))
+        return None
+
+    if not tool_path( tool ):
+        if not quiet_g:
+            warning(( str(err or "%s: can't find %s in path. Install?" % (entry, tool)) ))
+        return None
+
+    if batch:
+        return batch, True
+
+    return single, False
+
+
+def run_external(probe, files, batched, retry=None):
+
+    """ run an external probe over one or many files
+
+    A batch that times out is run again one file at a time, so only
+    the file that hangs the tool is lost.  A single file that times
+    out is tried once more with --retry, then skipped.  Only the last
+    try at each file is sampled for --stats.
+
+    Returns:
+        (dict): file name -> Track
+
+    """
+
+    start = time.perf_counter()
+    rerun = False       # the files are sampled by the run again instead
+
+    try:
+        if batched:
+            return probe( files )
+
+        return { files[0]: probe( files[0] ) }
+
+    except ProbeTimeout as err:
+        if past_deadline():
+            for entry in files:
+                skip( entry, err )
+            return {}
+
+        if batched and len(files) > 1:
+            rerun = True
+            found = {}
+            for entry in files:
+                found.update( run_external( probe, [entry], True, retry ) )
+            return found
+
+        if retry_g if retry is None else retry:
+            rerun = True
+            return run_external( probe, files, batched, False )
+
+        skip( files[0], err )
+        return {}
+
+    finally:
+        if stats_g and not rerun:
+            stats_g.sample( FORMATS[ format_of( files[0] ) ][1], time.perf_counter() - start,
+                            len(files) )
+
+
+def external_done(entry, st, err, probed):
+
+    """ take a file's tags out of an external probe's results
+
+    Args:
+       entry (string): name of an audio file
+       st (stat_result): os.stat() of the file before probing
+       err (Exception): why the in-process reader failed, if it did
+       probed (dict): what run_external returned
+
+    Returns:
+        (Track): the file's tags and length, or None
+
+    """
+
+    track = probed.get( entry )
+
+    if not track:
+        if err and not quiet_g:
+            warning(( str(err) ))
+        return probe_failed( entry, st, err )
+
+    if stats_g:
+        stats_g.count( "probed" )
+
+    if cache_g and track.seconds >= 0:
+        cache_g.put( entry, st, track )
+
+    return track
+
+
+def probe_one(entry):
+
+    """ get the tags of one file: cache, reader, then external tool
+
+    Args:
+       entry (string): name of an audio file
+
+    Returns:
+        (Track): the file's tags and length, or None
+
+    """
+
+    track, st, err = quick_info( entry )
+
+    if track or st is None:
+        return track
+
+    route = external_probe( entry, err )
+    if not route:
+        return probe_failed( entry, st, err, err is not None )
+
+    probe, batched = route
+
+    return external_done( entry, st, err, run_external( probe, [entry], batched ) )
+
+
+#----------------------
+class SerialPool(object):
+
+    """ stands in for a ThreadPoolExecutor with -j 1
+
+    Each call is run as it is submitted, in the calling thread.
+
+    """
+
+    def submit(self, fn, *args):
+
+        future = Future()
+
+        try:
+            future.set_result( fn( *args ) )
+        except BaseException as err:
+            future.set_exception( err )
+
+        return future
+
+
+    def shutdown(self, wait=True):
+        pass
+
+
+class Probe(object):
+
+    """ one file on its way through probe_all """
+
+    __slots__ = ( "entry", "quick", "routed", "batch", "external",
+                  "st", "err", "track", "done" )
+
+    def __init__(self, entry, quick):
+        self.entry = entry
+        self.quick = quick          # future of quick_info
+        self.routed = False         # quick result looked at
+        self.batch = None           # batch probe it is queued for
+        self.external = None        # future of run_external
+        self.st = self.err = self.track = None
+        self.done = False
+
+
+#----------------------
+def probe_all(flist, jobs=1, batch=64, flush=None, window=256, previous=None):
+
+    """ probe a list of files, several at a time, in order
+
+    Probes are started in playlist order and each entry is yielded as
+    soon as it and every entry before it are done.  At most window
+    files are in flight or waiting to be written, so memory stays
+    the same however long flist is, and it may be a generator.
+
+    Files the in-process readers can't handle are queued by external
+    tool; tools that take many files (metaflac, mp3info) get run once
+    per batch files, or as soon as the first file waiting on them is
+    the next to be written.
+
+    Args:
+       flist (iterable): filenames in playlist order
+       jobs  (int):      number of probes to run at once (0 = automatic)
+       batch (int):      files handed to an external tool at once
+       flush (function): called before waiting on an unfinished probe,
+                         so the entries so far can be written out
+       window (int):     most files in flight at once
+       previous (tuple): ( entries, since ) of a playlist being updated
+
+    Yields:
+        (Track): the tracks (None for files that failed) in the same
+                 order as flist; rendering them is up to the caller
+
+    """
+
+    batch = max( 1, batch )
+    window = max( 1, window )
+
+    if jobs == 1:
+        pool = SerialPool()
+    else:
+        pool = ThreadPoolExecutor( max_workers=jobs or None )
+
+    pending = deque()   # Probes in playlist order
+    finished = deque()  # Probes whose quick_info is done, from the workers
+    groups = {}         # batch probe -> Probes waiting for it
+
+
+    def send(probe):
+        """ start a batch probe on the files queued for it """
+        slots = groups.pop( probe, () )
+        if slots:
+            future = pool.submit( run_external, probe, [ s.entry for s in slots ], True )
+            for s in slots:
+                s.external = future
+
+
+    def route(slot):
+        """ look at the quick result, queue the file for a tool if needed """
+        if slot.routed:
+            return
+        slot.routed = True
+
+        slot.track, slot.st, slot.err = slot.quick.result()
+
+        if slot.track or slot.st is None:
+            slot.done = True
+            return
+
+        probe = external_probe( slot.entry, slot.err )
+
+        if not probe:
+            slot.track = probe_failed( slot.entry, slot.st, slot.err, slot.err is not None )
+            slot.done = True
+
+        elif probe[1]:
+            slot.batch = probe[0]
+            group = groups.setdefault( probe[0], [] )
+            group.append( slot )
+            if len(group) >= batch:
+                send( probe[0] )
+
+        else:
+            slot.external = pool.submit( run_external, probe[0], [slot.entry], False )
+
+
+    def advance(slot, block):
+        """ move a file along; True once its tags are known """
+
+        while finished:
+            route( finished.popleft() )
+
+        if not slot.routed:
+            if not ( block or slot.quick.done() ):
+                return False
+            route( slot )
+
+        if slot.done:
+            return True
+
+        if slot.external is None:       # still filling a batch
+            if not block:
+                return False
+            send( slot.batch )
+
+        if not ( block or slot.external.done() ):
+            return False
+
+        slot.track = external_done( slot.entry, slot.st, slot.err,
+                                   slot.external.result() )
+        slot.done = True
+        return True
+
+
+    def emit(limit):
+        """ the finished head of the line; waits while more than limit pend """
+        while pending:
+            head = pending[0]
+
+            if not advance( head, False ):
+                if len(pending) <= limit:
+                    return
+                if flush:
+                    flush()
+                advance( head, True )
+
+            pending.popleft()
+
+            if head.track:
+                # named as in flist, wherever the tags came from
+                head.track.path = head.entry
+            elif stats_g and head.err is not QUARANTINED:
+                stats_g.count( "failed" )
+
+            yield head.track
+
+
+    try:
+        for entry in flist:
+
+            if not format_of( entry ):
+                continue
+
+            slot = Probe( entry, pool.submit( quick_info, entry, previous ) )
+            slot.quick.add_done_callback( lambda f, s=slot: finished.append(s) )
+            pending.append( slot )
+
+            for out in emit( window - 1 ):
+                yield out
+
+        for out in emit( 0 ):
+            yield out
+
+    finally:
+        pool.shutdown()
+
+
+#----------------------
+def read_m3u(m3ufile):
+
+    """ read back a playlist written by write_m3u
+
+    Each #EXTINF line gives the seconds and "artist - title" of the
+    file named on the next line; album and date come from the
+    footer, as that is all the playlist keeps of them.
+
+    Args:
+       m3ufile (string): name of the playlist
+
+    Returns:
+       ( entries, since ): normalized file name -> Track, and the
+                           playlist's mtime_ns; files changed ( by
+                           st_ctime ) after it was written must be
+                           probed again.
+                           ( {}, 0 ) if there is no playlist.
+
+    """
+
+    entries = {}
+    footer = {}
+    extinf = None
+
+    try:
+        since = os.stat( m3ufile ).st_mtime_ns
+
+        with open( m3ufile ) as f:
+            lines = f.read().split('\n')
+
+    except (OSError, IOError):
+        return entries, 0
+
+    for line in lines:
+
+        if line.startswith( "#EXTINF:" ):
+            extinf = line[8:]
+
+        elif line.startswith( "# " ):
+            key, colon, value = line[2:].partition( ": " )
+            if colon:
+                footer[key] = value
+
+        elif line and not line.startswith( "#" ) and extinf:
+            secs, comma, text = extinf.partition( ',' )
+            extinf = None
+
+            try:
+                secs = int( float(secs) )
+            except ValueError:
+                continue
+
+            if secs < 0:        # never got a duration, try again
+                continue
+
+            artist, dash, title = text.partition( " - " )
+            entries[ os.path.normpath(line) ] = Track( line, artist, title, seconds=secs )
+
+    # the footer comes last
+    album, date = footer.get( "Album", "" ), footer.get( "Date", "" )
+
+    for track in entries.values():
+        track.album, track.date = album, date
+
+    return entries, since
+
+
+#----------------------
+def m3u_footer(summary):
+
+    """ the comments closing a playlist: artist, album, duration and date """
+
+    artist, album, date = summary.footer()
+
+    return "\n".join( ( "# Artist: " + artist,
+                        "# Album: " + album,
+                        "# Duration: " + ( "~" if summary.approx else "" ) + hms(summary.seconds),
+                        "# Date: " + date,
+                        "# playlist.py copyright 2015-2020 by chris reid",
+                        "#END\n" ) )
+
+
+#----------------------
+def scan(paths, recursive=False, sort=False, jobs=None, previous=None):
+
+    """ find the audio files among some paths and read their tags
+
+    This and render_m3u are for using playlist as a library, without
+    running a process for each playlist:
+
+        import playlist
+
+        with open( "album.m3u", "w" ) as f:
+            playlist.render_m3u( playlist.scan( [ "album" ] ), f )
+
+    Each scan has its own pool of probes and nothing but warnings is
+    printed, so scans can run at once in several threads.  What the
+    command line would set ( --backend, -b, -w, -q ) is read from the
+    module settings, and the metadata cache is only used if one has
+    been opened into cache_g ( playlist.cache_g = playlist.open_cache() ).
+
+    Args:
+       paths (list):        files and directories, as on the command line
+       recursive (boolean): descend into subdirs if true
+       sort (boolean):      sort the files by name
+       jobs (int):          probes to run at once (default: -j setting)
+       previous (tuple):    ( entries, since ) from read_m3u, to reuse
+
+    Yields:
+        (Track): the files that could be read, in playlist order
+
+    """
+
+    flist = iter_files( paths, recursive )
+
+    if sort:
+        flist = sorted( flist )
+
+    if jobs is None:
+        jobs = jobs_g
+
+    for track in probe_all( flist, jobs, batch_g, None, window_g, previous ):
+        if track:
+            yield track
+
+
+def render_m3u(tracks, stream, shuffled=False, base=None):
+
+    """ write tracks out as an M3U-EX playlist
+
+    Args:
+       tracks (iterable): Tracks, or None for files to leave out
+       stream (file):     where to write the playlist
+       shuffled (boolean): mark the playlist as shuffled
+       base (string):     the directory the playlist will be in, if the
+                          files are to be named relative to it
+
+    Returns:
+        (Summary): the artist, album, date and length of the playlist
+
+    """
+
+    summary = Summary()
+
+    stream.write( "#EXTM3U\n\n" )
+
+    if shuffled:
+        stream.write( "# SHUFFLED LIST\n" )
+
+    for track in tracks:
+
+        if not track:
+            continue
+
+        summary.add( track )
+
+        if base is None:
+            stream.write( make_entry( track ) + "\n" )
+        else:
+            stream.write( make_entry( track, os.path.relpath( track.path, base ) ) + "\n" )
+
+    stream.write( m3u_footer( summary ) + "\n" )
+
+    return summary
+
+
+#----------------------
+def write_m3u( flist , outfile=None , sort=False, rand=False, jobs=None,
+               previous=None ):
+
+    """ write out the M3U-EX info  from the mp3 files
+
+    Unless the list is sorted or shuffled, flist is read as the
+    entries are written, so it can be a generator straight from
+    iter_files and the first entries go out while the rest are
+    still being found.
+
+    Args:
+       flist (iterable): filenames (mp3, flac, ...)
+       jobs  (int):      probes to run at once (default: -j setting)
+       previous (tuple): ( entries, since ) from the playlist being
+                         updated; see read_m3u.  The new playlist is
+                         written to a temporary file and renamed over
+                         outfile when it is complete.
+
+    Returns:
+        None
+
+    """
+
+    if outfile:
+        try:
+            f = open(outfile + ".part" if previous else outfile, 'w')
+        except IOError as io:
+
+            fatal( "[error opening %s for writing: %s]\n" % (outfile , io), io.errno)
+    else:
+        f = sys.stdout
+
+    if sort:
+        flist = sorted(flist)
+
+    if rand:
+        flist = list(flist)
         shuffle(flist)
 
+    if jobs is None:
+        jobs = jobs_g
+
+    tracks = probe_all(flist, jobs, batch_g, f.flush, window_g, previous)
+
+    if stats_g:
+        tracks = stats_g.timed( "probing", tracks )
+        was = stats_g.enter( "output" )
+
+    try:
+        render_m3u( tracks, f, rand )
+    finally:
+        if outfile:
+            f.close()
+        if stats_g:
+            stats_g.enter( was )
+
+    if outfile and previous:
+        os.replace(outfile + ".part", outfile)
+
+
+def write_dirs( flist, sort=False, rand=False, jobs=None ):
+
+    """ write a playlist into each directory with audio files in it
+
+    The whole list goes through one probe_all, so a library is probed
+    with one pool however many playlists come out of it.  Each
+    playlist is named after its directory, like -a names one after
+    the current directory, lists the directory's own files by their
+    plain names, and has the album, artist and date of just those
+    files.  The files of a directory come together in iter_files
+    order, so the playlists are written one after another as the
+    entries come in, each to a temporary file renamed when complete.
+
+    Args:
+       flist (iterable): filenames, each directory's files together
+       sort (boolean):   sort each playlist
+       rand (boolean):   shuffle each playlist
+       jobs (int):       probes to run at once (default: -j setting)
+
+    Returns:
+        None
+
+    """
+
+    if sort:
+        flist = sorted( flist, key=lambda p: ( os.path.dirname(p), p ) )
+
+    if rand:
+        flist = list( flist )
+        shuffle( flist )
+        flist.sort( key=os.path.dirname )   # stays shuffled within each
+
+    if jobs is None:
+        jobs = jobs_g
+
+    order = deque()     # files handed to probe_all, not yet written
+    current = [ None ]  # the playlist being written
+
+    def files():
+        for entry in flist:
+            if format_of( entry ):
+                order.append( entry )
+                yield entry
+
+    def flush():
+        if current[0]:
+            current[0].flush()
+
+    tracks = probe_all( files(), jobs, batch_g, flush, window_g )
+
+    if stats_g:
+        tracks = stats_g.timed( "probing", tracks )
+        was = stats_g.enter( "output" )
+
+    # the failed files come out as None, so pair them up by count
+    tracks = ( ( order.popleft(), track ) for track in tracks )
+
+    for directory, group in groupby( tracks, key=lambda t: os.path.dirname( t[0] ) ):
+
+        name = os.path.basename( os.path.abspath( directory or "." ) ) + ".m3u"
+        outfile = os.path.join( directory, name )
+
+        try:
+            current[0] = open( outfile + ".part", 'w' )
+        except IOError as io:
+            if not quiet_g:
+                warning(( "[error opening %s for writing: %s]" % (outfile, io) ))
+            continue
+
+        with current[0]:
+            render_m3u( ( track for entry, track in group ), current[0], rand,
+                        directory or "." )
+
+        current[0] = None
+        os.replace( outfile + ".part", outfile )
+
+        if not quiet_g:
+            info(( outfile ))
+
+    if stats_g:
+        stats_g.enter( was )
+
+#------------------------------------------
+
+def program_check(programs=None):
+
+    """ see what programs are present to use """
+    for p in programs:
+
+        found = which(p)
+
+        if  found:
+            print( ("%s: found %s\n" % (p, found)) )
+        else:
+            if not quiet_g:
+                warning( ("%s %s\n" % (p, "not found in path. Install?")) )
+
+
+def show_quarantine():
+
+    """ list the files in quarantine, why and when they'll be tried again """
+
+    cache = open_cache()
+
+    if not cache:
+        fatal( "no metadata cache to look in\n", ENOENT )
+
+    try:
+        for path, error, failures, retry in cache.quarantine_list():
+            print( path )
+            print( "    %s (failed %d time%s, next try %s)"
+                   % ( error, failures, "" if failures == 1 else "s",
+                       time.strftime( "%Y-%m-%d %H:%M", time.localtime( retry ) ) ) )
+    finally:
+        cache.close()
+
+
+#------------------------------------------
+def option_value(o, args, i):
+
+    """ fetch the value of an option that takes one
+
+    Args:
+       o    (string): the option as given ( -j 4  or  --jobs=4 )
+       args (list):   the command line
+       i    (int):    index of the word after the option
+
+    Returns:
+       (value, i):    the value and the index of the next word
+
+    """
+
+    if "=" in o:
+        return o.split("=", 1)[1], i
+
+    if i < len(args):
+        return args[i], i + 1
+
+    fatal( ("need a value for option  %s\n" % o), EINVAL )
+
+
+def int_value(o, value):
+
+    """ convert an option value to a positive int or die """
+
+    try:
+        n = int(value)
+        if n < 0:
+            raise ValueError(value)
+        return n
+
+    except ValueError:
+        fatal( ("option %s needs a number, not %s\n" % (o, value)), EINVAL )
+
+
+#------------------------------------------
+def parse_args(args, recursive=False, outfile=None, randomlist=False):
+
+    """ parse the command line arguments
+
+    a low-budget command line option parser.
+
+    Args:
+       args (list):         the command line given
+
+    Returns:
+       args(list):          the parsed command line
+       recursive(boolean):  recurse directories
+
+    """
+
+    global quiet_g
+    global jobs_g
+    global batch_g
+    global window_g
+    global cache_mode_g
+    global update_g
+    global watch_g
+    global per_directory_g
+    global daemon_g
+    global stats_g
+    global stats_file_g
+    global timeout_g
+    global retry_g
+    global deadline_g
+    global fallback_g
+    global fast_g
+
+    sort_list = False
+    
+    if len(args) == 0:
+        return args, False
+
+    rest = args[:1]
+    i = 1
+
+    while i < len(args):
+        o = args[i]
+        i += 1
+        #  print("o %s\n" % o)
+
+        # --jobs=4 style
+        name = o.split("=", 1)[0] if o.startswith("--") else o
+
+        if o in ( "-h", "-help", "--help", "help", "--options" , "options" ):
+            usage(sys.stdout, "long")
+            sys.exit(NOERR)
+
+        elif o in ( "-v", "-ver", "--version", "version" ):
+            version(sys.stdout)
+            sys.exit(NOERR)
+
+        elif o in ( "-q", "-quiet", "--quiet", "quiet" ):
+            quiet_g = True
+
+        elif o in ( "-a", "-auto", "--auto", "auto" ):
+
+            dirname = os.path.basename( os.getcwd() )
+            outfile= ''.join( ( dirname, '.m3u' ) )
+            if not quiet_g: info((outfile))
+
+        elif o  in (  "-c", "-check", "--check", "check") :
+            programs = [ 'metaflac' , 'mp3info', 'ogginfo' , 'mp4info' ]
+            program_check(programs)
+            sys.exit(NOERR)
+
+        elif name in ( "-f", "--file", "--update" ):
+
+            outfile, i = option_value(o, args, i)
+            print(( "playlist: ", outfile))
+
+            fpath= os.path.join( os.getcwd() , outfile )
+
+            # print(("fpath:", fpath))
+
+            if name == "--update":
+                # the old playlist is read back, then replaced
+                update_g = True
+
+            elif os.path.isfile( fpath):
+                oldfile = outfile + ".old"
+                os.rename(outfile, oldfile)
+
+        elif name in ( "-j", "--jobs" ):
+            value, i = option_value(o, args, i)
+            jobs_g = int_value(o, value)
+
+        elif name == "--backend":
+            value, i = option_value(o, args, i)
+            try:
+                set_backend( value )
+            except ValueError as err:
+                fatal( ("option %s: %s\n" % (o, err)), EINVAL )
+
+        elif name in ( "-b", "--batch" ):
+            value, i = option_value(o, args, i)
+            batch_g = max( 1, int_value(o, value) )
+
+        elif name in ( "-w", "--window" ):
+            value, i = option_value(o, args, i)
+            window_g = max( 1, int_value(o, value) )
+
+        elif o == "--no-cache":
+            cache_mode_g = "off"
+
+        elif o == "--rebuild-cache":
+            cache_mode_g = "rebuild"
+
+        elif o == "--watch":
+            watch_g = True
+
+        elif o == "--daemon":
+            daemon_g = True
+
+        elif name == "--timeout":
+            value, i = option_value(o, args, i)
+            timeout_g = int_value(o, value)
+
+        elif name == "--deadline":
+            value, i = option_value(o, args, i)
+            deadline_g = int_value(o, value)
+
+        elif o == "--retry":
+            retry_g = True
+
+        elif o == "--fallback":
+            fallback_g = True
+
+        elif o == "--fast":
+            fast_g = True
+
+        elif o == "--show-quarantine":
+            show_quarantine()
+            sys.exit(NOERR)
+
+        elif o == "--stats":
+            stats_g = stats_g or Stats()
+
+        elif name == "--stats-file":
+            stats_file_g, i = option_value(o, args, i)
+            stats_g = stats_g or Stats()
+
+        elif o == "--no-daemon":
+            pass                # seen by main
+
+        elif o == "--per-directory":
+            per_directory_g = True
+            recursive = True
+
+        elif o in ( "-s", "--sort" ):
+            sort_list = True
+
+        elif o in ( "-r", "--recursive" ):
+            recursive = True
+
+        elif o in ( "-R", "--random" ):
+            randomlist = True
+
+        elif o == "--":
+            rest.extend( args[i:] )
+            break
+
+        elif o.startswith("-"):
+            usage(sys.stderr)
+            fatal( ("unkown option %s\n" % o), EINVAL )
+
+        else:
+            rest.append(o)
+
+
+    if per_directory_g and ( outfile or watch_g ):
+        fatal( "--per-directory names its own playlists"
+               " ( no -a, -f, --update or --watch )\n", EINVAL )
+
+    return (rest, recursive, outfile, sort_list, randomlist)
+
+#------------------------------------------------------------
+def iter_files(paths, recursive=False):
+
+    """ find the audio files among some files and directories
+
+    Directories are read with os.scandir, so the type of each entry
+    comes with the listing and plain files are never stat'ed;
+    extensions are matched case-insensitively ( .FLAC, .Mp3 ).
+    The files of a directory come before those of its subdirectories,
+    and hidden files ( .foo, macOS ._foo droppings ) are skipped.
+    Recursive runs with the cache on go through walk_tree, which
+    skips listing directories that haven't changed.
+
+    Args:
+          paths(list or str):  a filename, dir, or list of files or
+                               directories or a mix of both.
+          recursive(boolean):  descend into subdirs if true
+
+    Yields:
+          (string): the relative path of each audio file, once
+
+    """
+
+    if isinstance(paths, str): paths = [paths]
+
+    for d in distinct_paths( paths, recursive ):
+
+        key = os.path.normpath(d)
+
+        if os.path.isdir(d) and recursive and cache_g:
+            for path in walk_tree( "" if key == "." else d ):
+                yield path
+
+        elif os.path.isdir(d):
+            # "." lists as plain names, like os.listdir(".") used to
+            stack = [ "" if key == "." else d ]
+
+            while stack:
+                top = stack.pop()
+                subdirs = []
+
+                try:
+                    listing = os.scandir( top or "." )
+                except OSError as err:
+                    if not quiet_g:
+                        warning(( str(err) ))
+                    continue
+
+                with listing:
+                    for entry in listing:
+
+                        if entry.name.startswith('.'):
+                            continue
+
+                        path = os.path.join( top, entry.name )
+
+                        if format_of( entry.name ):
+                            if entry.is_file():
+                                yield path
+
+                        elif recursive and entry.is_dir( follow_symlinks=False ):
+                            subdirs.append( path )
+
+                # depth first, in listing order
+                stack.extend( reversed(subdirs) )
+
+        elif format_of(d) and os.path.isfile(d):
+            yield d
+
+
+def distinct_paths(paths, recursive=False):
+
+    """ leave out the arguments whose files another argument lists
+
+    A file or directory named twice, however it is spelled, is kept
+    the first time; a file in a directory that is given too is left
+    out, as is anything under one with recursive ( not in a hidden
+    directory, which isn't walked ).  Paths are compared
+    by os.path.realpath, but a symlink is left in, as the walk doesn't
+    follow it.
+
+    Args:
+          paths(list):         files and directories
+          recursive(boolean):  whether directories are walked
+
+    Returns:
+          (list): the paths left, in the order given
+
+    """
+
+    def real(path):
+        if os.path.isdir(path) and not os.path.islink(path):
+            return os.path.realpath(path)
+        head, name = os.path.split( os.path.abspath(path) )
+        return os.path.join( os.path.realpath(head), name )
+
+    reals = [ real(d) for d in paths ]
+    dirs = set( r for d, r in zip( paths, reals ) if os.path.isdir(d) )
+
+    def listed(path, isdir):
+        """ whether a directory given lists path too """
+        if isdir and not recursive:
+            return False
+        while True:
+            parent, name = os.path.split( path )
+            if name.startswith('.') or parent == path:  # hidden ones aren't walked
+                return False
+            if parent in dirs:
+                return True
+            if not recursive:
+                return False
+            path = parent
+
+    seen = set()
+    kept = []
+
+    for d, r in zip( paths, reals ):
+        if r in seen or listed( r, r in dirs ):
+            continue
+        seen.add(r)
+        kept.append(d)
+
+    return kept
+
+
+def dir_fingerprint(own, children):
+
+    """ roll the hash of a directory's own part up with its children's
+
+    Args:
+          own(string):      hash of the directory's mtime, and the names,
+                            sizes and mtimes of its audio files
+          children(list):   fingerprints of its subdirectories
+
+    Returns:
+          (string): the fingerprint of the whole subtree
+
+    """
+
+    return hashlib.sha1( json.dumps( [ own ] + list(children) ).encode('utf-8') ).hexdigest()
+
+
+def walk_tree(top):
+
+    """ find the audio files under a directory, reusing stored fragments
+
+    A directory whose mtime is what it was when its fragment was
+    stored has had no file added, removed or renamed, so it is not
+    listed again: the names come out of the fragment
+    ( MetaCache.get_dir ).  A file rewritten in place leaves that
+    mtime alone, though, so each file is still stat'ed, and only
+    while its size and mtime match the fragment does quick_info pick
+    its tags up from cache_g.known instead of probing.
+
+    Directories that are new or changed, or hold a changed file, are
+    listed or probed again and marked, along with every directory
+    above them whose fingerprint no longer rolls up, to be stored
+    again when the cache is closed.
+
+    Args:
+          top(string):  a directory
+
+    Yields:
+          (string): the relative path of each audio file, in the same
+                    order as iter_files
 
-    for entry in flist:
+    Returns:
+          (string): the fingerprint of the subtree, None if it changed
 
-        if ".flac" in entry:
-            out = get_flac_entry( entry )
+    """
 
-        elif  ".mp3" in entry:
-            out = get_mp3_entry( entry )
+    try:
+        mtime_ns = os.stat( top or "." ).st_mtime_ns
+    except OSError as err:
+        if not quiet_g:
+            warning(( str(err) ))
+        return None
 
-        elif  ".m4a" in entry:
-            out = get_m4a_entry( entry )
+    row = cache_g.get_dir( top or "." )
 
-        elif  ".ogg" in entry:
-            out = get_ogg_entry( entry )
+    if row and row[0] == mtime_ns:
+        files, subdirs = row[3], row[4]
 
-        else:
-            continue
+    else:
+        row = None
+        files, subdirs = [], []
 
-        if out:
-            duration += dur(out)
+        try:
+            listing = os.scandir( top or "." )
+        except OSError as err:
+            if not quiet_g:
+                warning(( str(err) ))
+            return None
 
-            #print("duration::" , duration)
+        with listing:
+            for entry in listing:
 
+                if entry.name.startswith('.'):
+                    continue
 
-        print( out )
+                if format_of( entry.name ):
+                    if entry.is_file():
+                        files.append( [ entry.name, None, None, None ] )
 
-    print(("# Artist: " + artist_name_g) )
-    print(("# Album: " + album_name_g)   )
+                elif entry.is_dir( follow_symlinks=False ):
+                    subdirs.append( entry.name )
 
-    print(( "# Duration: " + hms(duration) ))
+    complete = row is not None
 
-    print(( "# Date: " + date_g ))
+    for name, size, mtime, tags in files:
 
-    print ("# playlist.py copyright 2015-2020 by chris reid")
+        path = os.path.join( top, name )
 
+        if tags:
+            start = time.perf_counter()
+            try:
+                st = os.stat( path )
+            except OSError:
+                st = None
 
+            if stats_g:
+                stats_g.sample( "stat", time.perf_counter() - start )
 
-    print("#END\n")
+            if st and ( st.st_size, st.st_mtime_ns ) == ( size, mtime ):
+                cache_g.known[path] = Track( path, *tags )
+            else:
+                complete = False
+        else:
+            complete = False
 
-    sys.stdout = sys.__stdout__ # restore stdout
-#------------------------------------------
+        yield path
 
-def program_check(programs=None):
+    children = []
 
-    """ see what programs are present to use """
-    for p in programs:
+    for sub in subdirs:
+        fingerprint = yield from walk_tree( os.path.join( top, sub ) )
+        children.append( fingerprint or "" )
 
-        found = which(p)
+    if complete and dir_fingerprint( row[2], children ) == row[1]:
+        return row[1]
 
-        if  found:
-            print( ("%s: found %s\n" % (p, found)) )
-        else:
-            if not quiet_g:
-                warning( ("%s %s\n" % (p, "not found in path. Install?")) )
+    cache_g.mark_dir( top or ".", mtime_ns, [ f[0] for f in files ], subdirs )
 
+    return None
 
-#------------------------------------------
-def parse_args(args, recursive=False, outfile=None, randomlist=False):
 
-    """ parse the command line arguments
+def get_files(_dir, recursive = False):
 
-    a low-budget command line option parser.
+    """ get a directory list of wanted files
 
     Args:
-       args (list):         the command line given
+          _dir(list or str):   a string of a filename, dir, or list of
+                               files or directories or a mix of both.
+         recursive(boolean):  descend into subdirs if true
 
     Returns:
-       args(list):          the parsed command line
-       recursive(boolean):  recurse directories
+           audiofiles(list): a list of known audiofiles to process.
+                             The strings are the relative path of each file.
 
     """
 
-    global quiet_g
+    return list( iter_files( _dir, recursive ) )
 
-    sort_list = False
-    
-    if len(args) == 0:
-        return args, False
 
-    #    for o in args:
-    if len(args) > 1:
-        o = args[1]
-        #  print("o %s\n" % o)
+#-----------------------------------------------------------
+def make_playlist(args, recursive=False, outfile=None, sortlist=False, randomlist=False):
 
-        if len(args) >2:
-            if args[2].startswith( '-', 0, 1 ):
-                
-                fatal( "Only one option can be used.\n")
-                usage(sys.stdout)
-                sys.exit(22) # EINVAL
+    """ find the audio files and write the playlist
 
-        if o in ( "-h", "-help", "--help", "help", "--options" , "options" ):
-            usage(sys.stdout, "long")
-            sys.exit(NOERR)
+    Args:
+        args (list):          the command line left over after parse_args
+        recursive(boolean):   descend into subdirs if true
+        outfile(string):      playlist file or None for standard output
+        sortlist(boolean):    sort the playlist
+        randomlist(boolean):  shuffle the playlist
 
-        elif o in ( "-v", "-ver", "--version", "version" ):
-            version(sys.stdout)
-            sys.exit(NOERR)
+    Returns:
+        None
 
-        elif o in ( "-q", "-quiet", "--quiet", "quiet" ):
-            quiet_g = True
+    """
 
-        elif o in ( "-a", "-auto", "--auto", "auto" ):
+    global deadline_at_g
 
-            dirname = os.path.basename( os.getcwd() )
-            outfile= ''.join( ( dirname, '.m3u' ) )
-            if not quiet_g: info((outfile))
+    paths = args[1:] or [ "." ]     # use cwd if not given
 
-        elif o  in (  "-c", "-check", "--check", "check") :
-            programs = [ 'metaflac' , 'mp3info', 'ogginfo' , 'mp4info' ]
-            program_check(programs)
-            sys.exit(NOERR)
+    # the clock starts again for each watch rebuild and daemon request
+    deadline_at_g = None if deadline_g is None else time.monotonic() + deadline_g
 
-        elif o in ( "-f", "--file" ):
+    # found, probed and written as we go
+    file_list = iter_files( paths, recursive )
 
-            if len(args) > 2:
-                outfile = args[2]
-                print(( "playlist: ", outfile))
-            else:
-                fatal( ("need filename for option  %s\n" % o), EINVAL )
+    if stats_g:
+        file_list = stats_g.timed( "discovery", file_list )
 
-            fpath= os.path.join( os.getcwd() , outfile )
+    first = next( file_list, None )
 
-            # print(("fpath:", fpath))
+    previous = read_m3u( outfile ) if ( update_g or watch_g ) and outfile else None
 
-            if os.path.isfile( fpath):
-                oldfile = outfile + ".old"
-                os.rename(outfile, oldfile)
+    if first and per_directory_g:
+        write_dirs(chain( [first], file_list ), sortlist, randomlist)
 
-        elif o in ( "-q", "-quiet", "--quiet", "quiet" ):
-            quiet_g= True
+    elif first:
+        write_m3u(chain( [first], file_list ), outfile, sortlist, randomlist,
+                  previous=previous)
 
-        elif o in ( "-s", "--sort" ):
-            sort_list = True
+    elif watch_g or update_g:
+        # the last file went away; don't leave the old list behind
+        write_m3u([], outfile, previous=previous)
 
-        elif o in ( "-r", "--recursive" ):
-            recursive = True
+    elif not quiet_g:
+        usage(sys.stdout)
+        info("no audio files found   (dir?)")
 
 
-        elif o in ( "-R", "--random" ):
-            randomlist = True
+#-----------------------------------------------------------
+class Inotify(object):
 
+    """ a small ctypes wrapper around the Linux inotify calls
 
-        elif o in ( "-"):
-            fatal(("unkown option %s\n" % o), EINVAL )
+    Just what --watch needs: watch directories, and read back what
+    happened in them as ( directory, mask, name ) tuples.
 
-        elif o in ( "--"):
-            pass
+    """
 
-        else:
-            usage(sys.stdout)
-            fatal( ("unkown option %s\n" % o), EINVAL )
+    ATTRIB      = 0x00000004
+    CLOSE_WRITE = 0x00000008
+    MOVED_FROM  = 0x00000040
+    MOVED_TO    = 0x00000080
+    CREATE      = 0x00000100
+    DELETE      = 0x00000200
+    DELETE_SELF = 0x00000400
+    MOVE_SELF   = 0x00000800
+    Q_OVERFLOW  = 0x00004000
+    IGNORED     = 0x00008000
+    ONLYDIR     = 0x01000000
+    ISDIR       = 0x40000000
 
+    MASK = ( ATTRIB | CLOSE_WRITE | MOVED_FROM | MOVED_TO | CREATE | DELETE |
+             DELETE_SELF | MOVE_SELF | ONLYDIR )
 
-        args.remove(o)
+    def __init__(self):
 
+        if ctypes is None or not sys.platform.startswith( "linux" ):
+            raise OSError( ENOSYS, "inotify is only found on Linux" )
 
-    return (args, recursive, outfile, sort_list, randomlist)
+        self.libc = ctypes.CDLL( ctypes.util.find_library( "c" ) or "libc.so.6",
+                                 use_errno=True )
 
-#------------------------------------------------------------
+        self.fd = self.libc.inotify_init1( os.O_CLOEXEC )
+        if self.fd < 0:
+            self.error()
 
-def get_files(_dir, recursive = False):
+        self.dirs = {}      # watch descriptor -> directory
 
-    """ get a directory list of wanted files
+
+    def error(self, path=None):
+
+        err = ctypes.get_errno()
+        raise OSError( err, os.strerror(err), path )
+
+
+    def add(self, path):
+
+        """ watch a directory ( not those below it ) """
+
+        wd = self.libc.inotify_add_watch( self.fd, os.fsencode(path), self.MASK )
+        if wd < 0:
+            self.error( path )
+
+        self.dirs[wd] = path
+
+
+    def remove(self, path):
+
+        """ stop watching a directory and those below it, as it moved away """
+
+        below = path + os.sep
+
+        for wd, d in list( self.dirs.items() ):
+            if d == path or d.startswith( below ):
+                self.libc.inotify_rm_watch( self.fd, wd )
+                del self.dirs[wd]
+
+
+    def read(self, timeout=None):
+
+        """ wait for events
+
+        Args:
+            timeout(float):  seconds to wait, None for ever
+
+        Returns:
+            (list): ( directory, mask, name ) tuples, [] on a timeout;
+                    directory is None when the queue overflowed
+
+        """
+
+        if not select.select( [ self.fd ], [], [], timeout )[0]:
+            return []
+
+        data = os.read( self.fd, 65536 )
+        events = []
+        pos = 0
+
+        while pos + 16 <= len(data):
+            wd, mask, cookie, length = struct.unpack_from( "iIII", data, pos )
+            name = data[ pos + 16 : pos + 16 + length ].rstrip( b"\0" )
+            pos += 16 + length
+
+            if mask & self.IGNORED:     # the directory is gone
+                events.append( ( self.dirs.pop( wd, None ), mask, "" ) )
+            else:
+                events.append( ( self.dirs.get( wd ), mask, os.fsdecode(name) ) )
+
+        return events
+
+
+    def close(self):
+        os.close( self.fd )
+
+
+def watch(args, recursive=False, outfile=None, sortlist=False, randomlist=False):
+
+    """ write the playlist, then write it again whenever its files change
+
+    The directories given ( and with -r, all those below them ) are
+    watched with inotify.  A burst of events, like an album being
+    copied in, is left to settle for WATCH_QUIET seconds, or at most
+    WATCH_MAX_WAIT on a directory that never goes quiet, before the
+    playlist is rewritten.  Each rewrite reads the last playlist back
+    as --update does and the directories that changed have their
+    cached fragments dropped, so only the files added or changed are
+    probed; the new playlist is renamed over the old one when it is
+    complete.  Runs until interrupted.
 
     Args:
-          _dir(list or str):   a string of a filename, dir, or list of
-                               files or directories or a mix of both.
-         recursive(boolean):  descend into subdirs if true
+        same as make_playlist; outfile is required
 
     Returns:
-           audiofiles(list): a list of known audiofiles to process.
-                             The strings are the relative path of each file.
+        None
 
     """
 
+    if not outfile:
+        fatal( "--watch needs a playlist file ( -f, -a or --update )\n", EINVAL )
 
-    audiofiles=[]
+    try:
+        notify = Inotify()
+    except OSError as err:
+        fatal( ("--watch: %s\n" % err), ENOSYS )
 
-    if isinstance(_dir, str): _dir = [_dir]
+    paths = args[1:] or [ "." ]
 
-    # print ( "_dir:\t%s" % _dir)
-    # print ( "recursive:\t%s" % recursive)
+    singles = set()     # files named on the command line
+    parents = set()     # directories watched only for those
 
+    def add(top, deep):
 
-    for d in _dir:
-        if os.path.isdir(d):
-#            print("d:\t%s\n" % d)
-            if recursive:
-                for root, dirs, files in os.walk(d):
-                    for filename in files:
-                        if filename.endswith(extensions):
-                            audiofiles.append(os.path.join(root, filename ) )
+        try:
+            notify.add( top )
+        except OSError as err:
+            # most likely fs.inotify.max_user_watches
+            if not quiet_g:
+                warning(( "--watch: %s" % err ))
+            return
 
-            else:
-                if not d.endswith('/'): d = d + "/"
-                flist = glob.glob(d+'*')
+        if not deep:
+            return
+
+        try:
+            listing = os.scandir( top )
+        except OSError:
+            return
 
-                for f in flist:
-#                    print("GLOB:  %s\n" % f)
-                    if  os.path.isdir(f):
-                        continue  # skip -- not recursive
-                    if f.endswith(extensions):
-                        audiofiles.append(f);
+        with listing:
+            subdirs = [ entry.path for entry in listing
+                        if not entry.name.startswith('.')
+                        and entry.is_dir( follow_symlinks=False ) ]
 
+        for sub in subdirs:
+            add( sub, deep )
 
-        elif os.path.isfile(d):
-            if d.endswith(extensions):
-                audiofiles.append(d)
-        else:
-            pass
+    for p in paths:
+        if os.path.isdir( p ):
+            add( p, recursive )
+
+        elif format_of( p ):
+            singles.add( os.path.normpath(p) )
+            parent = os.path.dirname( p ) or "."
+            if parent not in parents:
+                parents.add( parent )
+                add( parent, False )
+
+    def changes(events):
+
+        """ the directories whose playlist entries may have changed """
+
+        changed = set()
+
+        for directory, mask, name in events:
+
+            if mask & Inotify.Q_OVERFLOW:
+                # lost track; look at everything again
+                changed.update( notify.dirs.values() )
+                continue
 
-#    print( "audiofiles: %s\n" % audiofiles)
+            if directory is None:
+                continue
+
+            if not name:                # the directory itself went away
+                changed.add( directory )
+                continue
+
+            if name.startswith('.'):
+                continue
+
+            path = os.path.join( directory, name )
+
+            if mask & Inotify.ISDIR:
+                if not recursive or directory in parents:
+                    continue
+
+                if mask & ( Inotify.MOVED_FROM | Inotify.DELETE ):
+                    notify.remove( path )
+
+                elif mask & ( Inotify.CREATE | Inotify.MOVED_TO ):
+                    add( path, True )
+
+                changed.add( directory )
+
+            elif format_of( name ):
+                if directory in parents and os.path.normpath(path) not in singles:
+                    continue
+
+                changed.add( directory )
+
+        return changed
+
+    try:
+        make_playlist( args, recursive, outfile, sortlist, randomlist )
+
+        while True:
+            if cache_g:
+                cache_g.sync()
+
+            changed = changes( notify.read() )
+            if not changed:
+                continue
+
+            deadline = time.monotonic() + WATCH_MAX_WAIT
+            quiet = time.monotonic() + WATCH_QUIET
+
+            while True:
+                wait = min( quiet, deadline ) - time.monotonic()
+                if wait <= 0:
+                    break
+
+                more = changes( notify.read( wait ) )
+                if more:
+                    changed |= more
+                    quiet = time.monotonic() + WATCH_QUIET
+
+            if cache_g:
+                for d in changed:
+                    cache_g.forget_dir( d )
+
+            make_playlist( args, recursive, outfile, sortlist, randomlist )
+
+            if not quiet_g:
+                info(( "%s rewritten" % outfile ))
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        notify.close()
 
-    return audiofiles
 
 #-----------------------------------------------------------
-def main(args):
+class SocketStream(object):
 
-    """ main driver playlist.py
+    """ stdout or stderr of a daemon request, sent down its socket
+
+    Writes are gathered and sent as frames: a byte naming the stream
+    ( "o" or "e" ), the length, and the text.  The frame "x" ends the
+    request, with the exit status in place of the length.
+
+    """
+
+    def __init__(self, conn, kind):
+        self.conn = conn
+        self.kind = kind
+        self.parts = []
+        self.size = 0
+
+
+    def write(self, text):
+
+        data = text.encode( 'utf-8', 'surrogateescape' )
+
+        self.parts.append( data )
+        self.size += len(data)
+
+        if self.size >= 65536:
+            self.flush()
+
+        return len(text)
+
+
+    def flush(self):
+
+        if self.size:
+            data = b"".join( self.parts )
+            self.conn.sendall( self.kind + struct.pack( ">I", len(data) ) + data )
+
+        self.parts = []
+        self.size = 0
+
+
+def serve_request(conn, defaults):
+
+    """ run one command line sent by a client, as main would
+
+    Requests are taken one at a time, so the module settings and
+    sys.stdout can be swapped for each one.
 
     Args:
-        sys.argv  (list) (string):  command line args
+        conn(socket):     the client
+        defaults(dict):   the settings to start each request from
+
+    """
+
+    with conn.makefile( 'rb' ) as f:
+        line = f.readline()
+
+    if not line:        # only checking we're here ( serve )
+        return
+
+    request = json.loads( line.decode( 'utf-8' ) )
+
+    for name, value in defaults.items():
+        globals()[name] = value.copy() if isinstance( value, (dict, list) ) else value
+
+    if stats_g:
+        globals()["stats_g"] = Stats()
+
+    out, err = SocketStream( conn, b"o" ), SocketStream( conn, b"e" )
+    status = NOERR
+
+    sys.stdout, sys.stderr = out, err
+
+    try:
+        os.chdir( request["cwd"] )
+
+        args, recursive, outfile, sortlist, randomlist = parse_args( request["argv"] )
+
+        make_playlist( args, recursive, outfile, sortlist, randomlist )
+
+        report_skipped()
+
+        if stats_g:
+            finish_stats()
+
+    except SystemExit as exit:
+        if exit.code is None or isinstance( exit.code, int ):
+            status = exit.code or NOERR
+        else:
+            status = EPERM
+
+    except (OSError, ValueError) as error:
+        warning(( str(error) ))
+        status = EPERM
+
+    finally:
+        sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+
+    out.flush()
+    err.flush()
+    conn.sendall( b"x" + struct.pack( ">I", status ) )
+
+
+def serve():
+
+    """ answer command lines from clients until killed ( --daemon )
+
+    The cache stays open and the tool paths stay looked up between
+    requests, so a repeat request costs little more than the client's
+    own start-up.  The settings given with --daemon ( -j, -q, --backend
+    and so on ) are where each request's own options start from.
+
+    """
+
+    path = daemon_socket()
+
+    if daemon_client_connect( path ):
+        fatal( ("a daemon is already listening on %s\n" % path), EPERM )
+
+    try:
+        os.makedirs( os.path.dirname( path ), exist_ok=True )
+        if os.path.exists( path ):     # left by a daemon that was killed
+            os.unlink( path )
+
+        server = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+        mask = os.umask( 0o077 )
+        try:
+            server.bind( path )
+        finally:
+            os.umask( mask )
+        server.listen( 16 )
+
+    except OSError as err:
+        fatal( ("--daemon: %s\n" % err), EPERM )
+
+    defaults = dict( ( name, globals()[name] ) for name in SETTINGS )
+
+    signal.signal( signal.SIGTERM, lambda signum, frame: sys.exit( NOERR ) )
+
+    if not quiet_g:
+        info(( "listening on %s" % path ))
+
+    home = os.getcwd()
+
+    try:
+        while True:
+            conn, address = server.accept()
+
+            with conn:
+                try:
+                    serve_request( conn, defaults )
+                except (OSError, ValueError, KeyError) as err:
+                    # the client went away, or didn't speak the protocol
+                    warning(( "request: %s" % err ))
+
+            os.chdir( home )
+
+            if cache_g:
+                cache_g.known.clear()   # left over if a request broke off
+                cache_g.sync()
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        server.close()
+        os.unlink( path )
+
+
+def daemon_client_connect(path):
+
+    """ a socket connected to a running daemon, or None """
+
+    conn = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+
+    try:
+        conn.connect( path )
+    except OSError:
+        conn.close()
+        return None
+
+    return conn
+
+
+def daemon_client(args):
+
+    """ have a running daemon do a command line
+
+    Args:
+        args(list):   the command line
 
     Returns:
-        None
+        (int): the exit status, or None if no daemon answered and the
+               command line is to be run here
 
     """
 
-    all_file_list = []
-    file_list     = []
-    recursive     = False
-    randomlist    = False
-    sortlist      = False
-    outfile       = None
+    conn = daemon_client_connect( daemon_socket() )
 
-    d             = "."
+    if not conn:
+        return None
 
+    with conn:
+        conn.sendall( json.dumps( { "argv": args, "cwd": os.getcwd() } ).encode( 'utf-8' )
+                      + b"\n" )
 
-    args, recursive, outfile, sortlist, randomlist = parse_args(args, recursive)
-    
-    
-    n_args = len(args)
+        f = conn.makefile( 'rb' )
+        streams = { b"o": sys.stdout.buffer, b"e": sys.stderr.buffer }
 
+        while True:
+            head = f.read( 5 )
 
-    if n_args == 1:
-        d = os.listdir(".")      # use cwd if not given
-    elif n_args == 2:
-        d = args[1] # file
-    else:
-        d = args[1:] # list
+            if len(head) < 5:
+                warning( "the daemon went away" )
+                return EPERM
 
+            size = struct.unpack( ">I", head[1:] )[0]
 
-    all_file_list = get_files( d , recursive)
-#    print (all_file_list)
+            if head[:1] == b"x":
+                sys.stdout.flush()
+                return size
 
-    # check extensions
-    if all_file_list:
-        for f in all_file_list:
-            if '.' in f:
-                ext = f.rsplit('.', 1)[1]
-                if ext in extensions:
-                    file_list.append(f)
+            stream = streams[ head[:1] ]
+            stream.write( f.read( size ) )
 
-    if file_list:
-        write_m3u(file_list, outfile, sortlist, randomlist)
-    else:
-        # ok options analyzed, lets make some file lists.
+            if stream is sys.stderr.buffer:
+                stream.flush()
 
-        d = os.getcwd() # no file list use current dir
 
-        if not d.endswith('/'): d = d+ "/"
+def close_stdout():
 
-        flacfiles = glob.glob(d + "*.flac")
-        mp3files  = glob.glob(d + "*.mp3" )
-        oggfiles  = glob.glob(d + "*.ogg" )
-        m4afiles  = glob.glob(d + "*.m4a" )
+    """ whoever read the pipe went away ( playlist | head );
+    point stdout at /dev/null so the exit flush stays quiet """
 
+    os.dup2( os.open( os.devnull, os.O_WRONLY ), sys.stdout.fileno() )
 
-        if sortlist:            
-            flacfiles.sort()
-            mp3files.sort()
-            oggfiles.sort()
-            m4afiles.sort()
-        
 
-        if randomlist:
-            shuffle(flacfiles)
-            shuffle(fmp3files)
-            shuffle(oggfiles)
-            shuffle(m4afiles)
+#-----------------------------------------------------------
+def main(args):
+
+    """ main driver playlist.py
+
+    Args:
+        sys.argv  (list) (string):  command line args
+
+    Returns:
+        None
+
+    """
 
+    global cache_g
 
-        allfiles = flacfiles + mp3files + oggfiles + m4afiles
+    recursive     = False
 
+    local = args[ 1 : args.index("--") if "--" in args else len(args) ]
 
-#        print( "allfiles %s\n" % allfiles)
+    if not any( o in LOCAL_OPTIONS for o in local ):
+        try:
+            status = daemon_client( args )
+        except BrokenPipeError:
+            close_stdout()
+            status = NOERR
 
-        if allfiles:
+        if status is not None:
+            sys.exit( status )
 
-            if sortlist:
-                allfiles.sort()
-            elif randomlist:
-                shuffle(allfiles)
+    args, recursive, outfile, sortlist, randomlist = parse_args(args, recursive)
 
-            write_m3u( allfiles, outfile )
+    if stats_g:
+        stats_g.enter( "tools" )
 
-        elif flacfiles:
-            write_m3u( flacfiles, outfile )
+    resolve_tools()
 
-        elif mp3files:
-            write_m3u( mp3files , outfile)
+    if stats_g:
+        stats_g.enter( "cache" )
 
-        elif oggfiles:
-            write_m3u( oggfiles ,outfile)
+    cache_g = open_cache(cache_mode_g)
 
-        elif m4afiles:
-            write_m3u( m4afiles, outfile )
+    if stats_g:
+        stats_g.enter( "other" )
 
+    try:
+        if daemon_g:
+            serve()
+        elif watch_g:
+            watch(args, recursive, outfile, sortlist, randomlist)
         else:
-            if not quiet_g:
-                usage()
-                info("no audio files found   (dir?)")
-            pass
+            make_playlist(args, recursive, outfile, sortlist, randomlist)
+
+    except BrokenPipeError:
+        close_stdout()
+
+    finally:
+        if stats_g:
+            stats_g.enter( "cache" )
+
+        if cache_g:
+            cache_g.close()
+            cache_g = None
+
+        # the daemon reported each request's to its client
+        if not daemon_g:
+            report_skipped()
+
+            if stats_g:
+                finish_stats()
 
 
 
@@ -1067,10 +4555,6 @@ if ( __name__ == '__main__' ) or (__name__ == '__builtin__'):
    main(sys.argv) # main driver
 
    sys.exit(NOERR) # clean exit
-   
-else:
-  # something is wrong if we are here
-  fatal(("name: " + __name__), ENOSYS)
 
 
 